@@ -1,9 +1,22 @@
 import asyncio
-import sqlite3
+import hashlib
+import heapq
+import itertools
+import json
 import logging
-from datetime import datetime
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
 from telegram import (
     Update,
+    ChatMember,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
@@ -14,137 +27,808 @@ from telegram import (
 from telegram.ext import (
     Application,
     CommandHandler,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     CallbackContext,
     ConversationHandler,
 )
-from telegram.error import NetworkError, Forbidden
+from telegram.error import BadRequest, NetworkError, Forbidden, RetryAfter, TimedOut
+
+import db
 
 application = None
 participate_handler = None
 
+# Период перечитывания таблицы admins в секундах. Нужен, только если с одной
+# базой работают несколько процессов бота; None отключает перечитывание.
+ADMIN_CACHE_RELOAD_INTERVAL = None
+
+# Апдейты разных пользователей обрабатываются параллельно, не больше
+# CONCURRENT_UPDATES одновременно; апдейты одного пользователя — по очереди.
+CONCURRENT_UPDATES = 256
+
+# Новые пользователи из /start пишутся в базу пачками: раз в
+# USER_FLUSH_INTERVAL секунд или как только наберется USER_FLUSH_BATCH id.
+USER_FLUSH_INTERVAL = 0.5
+USER_FLUSH_BATCH = 500
+# Точность отметки активности пользователя для сегментов «активные за N дней».
+ACTIVITY_RESOLUTION = 3600
+AUDIENCE_PAGE_SIZE = 1000
+BROADCAST_SNAPSHOT_DIR = "broadcast_snapshots"
+BROADCAST_DEDUP_WINDOW = 600
+SCHEDULE_TIME_FORMAT = "%d.%m.%Y %H:%M"
+# Планировщик перечитывает расписание не реже раза в минуту.
+SCHEDULER_MAX_SLEEP = 60
+
+# Рассылки: Bot API допускает около 30 сообщений в секунду на бота,
+# держим темп с запасом. Параллельные отправки скрывают сетевую задержку.
+BROADCAST_RATE = 25
+BROADCAST_CONCURRENCY = 10
+BROADCAST_MAX_RETRIES = 3
+# Общий темп сообщений бота (с тем же запасом до лимита Telegram) и лимиты
+# на один чат. В личном чате Telegram просит не больше сообщения в секунду,
+# но допускает короткие всплески: экран из нескольких сообщений уходит
+# сразу, а длинная серия идет раз в секунду.
+OUTBOUND_RATE = BROADCAST_RATE
+PRIVATE_CHAT_RATE = 1
+PRIVATE_CHAT_BURST = 5
+GROUP_CHAT_RATE = 1
+GROUP_CHAT_BURST = 3
+CHAT_BUCKETS_LIMIT = 10000
+BROADCAST_PROGRESS_INTERVAL = 3
+BROADCAST_CHECKPOINT_INTERVAL = 1.0
+BROADCAST_CHECKPOINT_BATCH = 200
+# Кэш проверок подписки на канал: подписку помним дольше, отсутствие
+# подписки — недолго, чтобы только что подписавшийся прошел проверку.
+SUBSCRIPTION_CHANNEL = "@BAZUMI_discountt"
+SUBSCRIPTION_TTL = 600
+SUBSCRIPTION_NEGATIVE_TTL = 5
+SUBSCRIPTION_CACHE_LIMIT = 50000
+# Подписке из таблицы channel_members верим без getChatMember сутки;
+# отсутствие подписки всегда перепроверяется запросом.
+CHANNEL_MEMBER_TTL = 86400
+# Перепроверка подписок участников перед розыгрышем идет через getChatMember
+# с тем же ограничением темпа, что и рассылки.
+SUBSCRIPTION_CHECK_RATE = 25
+SUBSCRIPTION_CHECK_CONCURRENCY = 10
+
+_admin_ids = set()
+_admin_lock = threading.Lock()
+_background_tasks = []
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-def init_db():
-    conn = sqlite3.connect("bazumi_bot.db")
+
+class UserIdSet:
+    """
+    Компактное множество user_id.
+
+    Основная часть хранится в отсортированном array('q') (8 байт на id) и
+    проверяется бинарным поиском; новые id копятся в небольшом set и
+    вливаются в массив пачками по MERGE_THRESHOLD.
+    """
+
+    MERGE_THRESHOLD = 4096
+
+    def __init__(self, ids=()):
+        self._sorted = array("q", sorted(ids))
+        self._recent = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        if user_id in self._recent:
+            return True
+        ids = self._sorted
+        i = bisect_left(ids, user_id)
+        return i < len(ids) and ids[i] == user_id
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, user_id):
+        with self._lock:
+            if user_id in self:
+                return
+            self._recent.add(user_id)
+            if len(self._recent) >= self.MERGE_THRESHOLD:
+                merged = self._sorted.tolist()
+                merged.extend(sorted(self._recent))
+                merged.sort()
+                # Сначала публикуем массив, потом очищаем set: читатель
+                # без блокировки всегда найдет id хотя бы в одном из них.
+                self._sorted = array("q", merged)
+                self._recent = set()
+
+    def nbytes(self):
+        """Приблизительный объем памяти структуры в байтах"""
+        return (
+            sys.getsizeof(self._sorted)
+            + sys.getsizeof(self._recent)
+            + 32 * len(self._recent)
+        )
+
+
+class WriteBehindBuffer:
+    """
+    Копит записи в памяти и сбрасывает их в базу одной транзакцией:
+    раз в interval секунд или сразу, когда накопилось max_items записей.
+    flush_func — синхронный хелпер, принимающий список записей.
+    Пачки пишутся по одной, в порядке поступления записей; flush()
+    возвращается, только когда в базе все, что было добавлено до вызова.
+    """
+
+    def __init__(self, flush_func, interval, max_items):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_items = max_items
+        self._items = []
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        self._items.append(item)
+        if len(self._items) >= self.max_items:
+            self._wakeup.set()
+
+    async def flush(self):
+        # Lock держится и на время записи: явный flush() дождется пачки,
+        # которую уже пишет run(), и следующая пачка не обгонит ее.
+        async with self._lock:
+            if not self._items:
+                return
+            items, self._items = self._items, []
+            write = asyncio.ensure_future(db.call(self.flush_func, items))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # Поток БД допишет пачку и после отмены: не отпускаем lock до тех пор.
+                await asyncio.wait([write])
+                if write.exception():
+                    logger.error(
+                        f"Error flushing {len(items)} items via {self.flush_func.__name__}: "
+                        f"{write.exception()}"
+                    )
+                raise
+            except Exception as e:
+                logger.error(f"Error flushing {len(items)} items via {self.flush_func.__name__}: {e}")
+                self._items[:0] = items
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+_verified_users = UserIdSet()
+_known_users = UserIdSet()
+
+
+class Contest(NamedTuple):
+    id: int
+    photo_id: str
+    title: str
+    end_date: str
+    status: str
+    message_id: Optional[int]
+
+
+_active_contest = None
+
+
+# Миграции схемы в порядке применения: (версия, описание, SQL-команды).
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    (
+        1,
+        "initial schema",
+        [
+            """CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY)""",
+            """CREATE TABLE IF NOT EXISTS contests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            photo_id TEXT,
+            title TEXT,
+            end_date TEXT,
+            status TEXT DEFAULT 'active',
+            message_id INTEGER
+        )""",
+            """CREATE TABLE IF NOT EXISTS participants (
+            contest_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            phone_number TEXT,
+            PRIMARY KEY (contest_id, user_id)
+        )""",
+            """CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            photo_id TEXT,
+            title TEXT,
+            text TEXT,
+            message_id INTEGER
+        )""",
+            """CREATE TABLE IF NOT EXISTS verified_users (
+            user_id INTEGER PRIMARY KEY,
+            phone_number TEXT,
+            verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+            """CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY)""",
+            "INSERT OR IGNORE INTO admins (user_id) VALUES (1950224047)",
+        ],
+    ),
+    (
+        2,
+        "indexes for hot lookups",
+        [
+            "CREATE INDEX IF NOT EXISTS idx_contests_status ON contests (status)",
+            "CREATE INDEX IF NOT EXISTS idx_participants_user ON participants (user_id)",
+            "CREATE INDEX IF NOT EXISTS idx_verified_users_phone ON verified_users (phone_number)",
+        ],
+    ),
+    (
+        3,
+        "persistent broadcast jobs",
+        [
+            """CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            payload TEXT,
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )""",
+            "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)",
+        ],
+    ),
+    (
+        4,
+        "mark unreachable users",
+        [
+            "ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP",
+            "CREATE INDEX IF NOT EXISTS idx_users_reachable ON users (user_id) WHERE blocked_at IS NULL",
+        ],
+    ),
+    (
+        5,
+        "streamed broadcast audience",
+        [
+            "ALTER TABLE broadcast_jobs ADD COLUMN segment TEXT",
+            "ALTER TABLE broadcast_jobs ADD COLUMN audience_cursor INTEGER DEFAULT 0",
+            "ALTER TABLE broadcast_jobs ADD COLUMN audience_complete INTEGER DEFAULT 0",
+        ],
+    ),
+    (
+        6,
+        "broadcast dedup key",
+        [
+            "ALTER TABLE broadcast_jobs ADD COLUMN dedup_key TEXT",
+        ],
+    ),
+    (
+        7,
+        "scheduled broadcasts",
+        [
+            """CREATE TABLE IF NOT EXISTS scheduled_broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            title TEXT,
+            payload TEXT,
+            contest_id INTEGER,
+            admin_chat_id INTEGER,
+            run_at TIMESTAMP,
+            status TEXT DEFAULT 'pending',
+            job_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+            "CREATE INDEX IF NOT EXISTS idx_scheduled_broadcasts_due ON scheduled_broadcasts (status, run_at)",
+        ],
+    ),
+    (
+        8,
+        "audience segments",
+        [
+            "ALTER TABLE users ADD COLUMN last_seen_at TIMESTAMP",
+            "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen_at) WHERE blocked_at IS NULL",
+        ],
+    ),
+    (
+        9,
+        "broadcast delivery stats",
+        [
+            "ALTER TABLE broadcast_jobs ADD COLUMN unreachable INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE broadcast_jobs ADD COLUMN rate_limited INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE broadcast_jobs ADD COLUMN retried INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE broadcast_jobs ADD COLUMN elapsed REAL NOT NULL DEFAULT 0",
+        ],
+    ),
+    (
+        10,
+        "channel members",
+        [
+            """CREATE TABLE IF NOT EXISTS channel_members (
+            user_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        ],
+    ),
+    (
+        11,
+        "participant subscription checks",
+        [
+            "ALTER TABLE participants ADD COLUMN subscribed INTEGER",
+            "ALTER TABLE participants ADD COLUMN checked_at TIMESTAMP",
+            """CREATE TABLE IF NOT EXISTS subscription_checks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            contest_id INTEGER NOT NULL,
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )""",
+            "CREATE INDEX IF NOT EXISTS idx_subscription_checks_status ON subscription_checks (status)",
+        ],
+    ),
+    (
+        12,
+        "media file_id cache",
+        [
+            """CREATE TABLE IF NOT EXISTS media_files (
+            sha256 TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        ],
+    ),
+    (
+        13,
+        "scheduled broadcast segments",
+        [
+            "ALTER TABLE scheduled_broadcasts ADD COLUMN segment TEXT",
+        ],
+    ),
+]
+
+# Основные запросы бота, планы которых пишутся в лог при старте.
+HOT_QUERIES = {
+    "active_contest": (
+        "SELECT id, photo_id, title, end_date, status, message_id "
+        "FROM contests WHERE status = 'active' LIMIT 1",
+        (),
+    ),
+    "is_participant": (
+        "SELECT 1 FROM participants WHERE contest_id = ? AND user_id = ?",
+        (0, 0),
+    ),
+    "get_participants": (
+        "SELECT username, phone_number, subscribed FROM participants WHERE contest_id = ?",
+        (0,),
+    ),
+    "unchecked_participants": (
+        "SELECT user_id FROM participants WHERE contest_id = ? AND user_id > ? "
+        "AND (checked_at IS NULL OR checked_at < ?) ORDER BY user_id LIMIT ?",
+        (0, 0, "", 1000),
+    ),
+    "participations_of_user": (
+        "SELECT contest_id FROM participants WHERE user_id = ?",
+        (0,),
+    ),
+    "audience_page": (
+        "SELECT user_id FROM users WHERE blocked_at IS NULL AND user_id > ? "
+        "ORDER BY user_id LIMIT ?",
+        (0, 1000),
+    ),
+    "segment_verified": (
+        "SELECT user_id FROM users WHERE blocked_at IS NULL "
+        "AND user_id IN (SELECT user_id FROM verified_users) AND user_id > ? "
+        "ORDER BY user_id LIMIT ?",
+        (0, 1000),
+    ),
+    "segment_participants": (
+        "SELECT user_id FROM users WHERE blocked_at IS NULL "
+        "AND user_id IN (SELECT user_id FROM participants WHERE contest_id = ?) AND user_id > ? "
+        "ORDER BY user_id LIMIT ?",
+        (0, 0, 1000),
+    ),
+    "segment_non_participants": (
+        "SELECT user_id FROM users WHERE blocked_at IS NULL "
+        "AND user_id NOT IN (SELECT user_id FROM participants WHERE contest_id = ?) AND user_id > ? "
+        "ORDER BY user_id LIMIT ?",
+        (0, 0, 1000),
+    ),
+    "segment_active": (
+        "SELECT user_id FROM users WHERE blocked_at IS NULL "
+        "AND last_seen_at >= datetime('now', '-7 days') AND user_id > ? "
+        "ORDER BY user_id LIMIT ?",
+        (0, 1000),
+    ),
+    "count_active": (
+        "SELECT COUNT(*) FROM users WHERE blocked_at IS NULL "
+        "AND last_seen_at >= datetime('now', '-7 days')",
+        (),
+    ),
+    "verified_phone": (
+        "SELECT phone_number FROM verified_users WHERE user_id = ?",
+        (0,),
+    ),
+    "verified_by_phone": (
+        "SELECT user_id FROM verified_users WHERE phone_number = ?",
+        ("",),
+    ),
+}
+
+
+def get_schema_version(conn):
     c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY)""")
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS contests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        photo_id TEXT,
-        title TEXT,
-        end_date TEXT,
-        status TEXT DEFAULT 'active',
-        message_id INTEGER
-    )"""
-    )
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS participants (
-        contest_id INTEGER,
-        user_id INTEGER,
-        username TEXT,
-        phone_number TEXT,
-        PRIMARY KEY (contest_id, user_id)
-    )"""
-    )
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS posts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        photo_id TEXT,
-        title TEXT,
-        text TEXT,
-        message_id INTEGER
-    )"""
-    )
     c.execute(
-        """CREATE TABLE IF NOT EXISTS verified_users (
-        user_id INTEGER PRIMARY KEY,
-        phone_number TEXT,
-        verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )"""
     )
-    c.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (1950224047))
-    conn.commit()
-    conn.close()
+    c.execute("SELECT MAX(version) FROM schema_version")
+    return c.fetchone()[0] or 0
+
+
+def apply_migrations():
+    """Применяет недостающие миграции, каждую в своей транзакции"""
+    with db.writer() as conn:
+        current = get_schema_version(conn)
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.writer() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN")
+            for statement in statements:
+                c.execute(statement)
+            c.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description),
+            )
+        logger.info(f"Applied schema migration {version}: {description}")
+
+
+def explain_hot_queries():
+    """Возвращает планы выполнения HOT_QUERIES: {имя: [строки плана]}"""
+    plans = {}
+    # EXPLAIN не сверяет версию схемы, поэтому читатель, открытый до миграций,
+    # показал бы план без новых индексов. Писатель видит актуальную схему.
+    with db.writer() as conn:
+        c = conn.cursor()
+        for name, (sql, params) in HOT_QUERIES.items():
+            c.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plans[name] = [row[3] for row in c.fetchall()]
+    return plans
+
+
+def init_db():
+    apply_migrations()
+    for name, plan in explain_hot_queries().items():
+        logger.info(f"Query plan [{name}]: {'; '.join(plan)}")
+    load_admins()
+    load_verified_users()
+    load_known_users()
+    load_media_file_ids()
+    with db.reader() as conn:
+        _load_active_contest(conn)
+
+
+def load_admins():
+    """Загружает таблицу admins в память"""
+    global _admin_ids
+    with _admin_lock:
+        with db.reader() as conn:
+            c = conn.cursor()
+            c.execute("SELECT user_id FROM admins")
+            _admin_ids = {row[0] for row in c.fetchall()}
+
+
+async def reload_admins_periodically(interval):
+    """Перечитывает admins, чтобы подхватить изменения из других процессов"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await db.call(load_admins)
+        except Exception as e:
+            logger.error(f"Error reloading admins: {e}")
+
 
 def is_admin(user_id):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,))
-    result = c.fetchone() is not None
-    conn.close()
-    return result
+    return user_id in _admin_ids
+
+
+def load_verified_users():
+    """Строит индекс верифицированных пользователей из verified_users"""
+    global _verified_users
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT user_id FROM verified_users ORDER BY user_id")
+        _verified_users = UserIdSet(row[0] for row in c)
+    logger.info(
+        f"Loaded {len(_verified_users)} verified users "
+        f"({_verified_users.nbytes() / 1024:.1f} KiB)"
+    )
 
 
 def is_user_verified(user_id):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM verified_users WHERE user_id = ?", (user_id,))
-    result = c.fetchone() is not None
-    conn.close()
-    return result
+    return user_id in _verified_users
+
+
+def get_verified_phone(user_id):
+    """Возвращает номер телефона верифицированного пользователя или None"""
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT phone_number FROM verified_users WHERE user_id = ?", (user_id,))
+        result = c.fetchone()
+    return result[0] if result else None
 
 
 def mark_user_verified(user_id, phone_number):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute(
-        "INSERT OR REPLACE INTO verified_users (user_id, phone_number) VALUES (?, ?)",
-        (user_id, phone_number),
-    )
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR REPLACE INTO verified_users (user_id, phone_number) VALUES (?, ?)",
+            (user_id, phone_number),
+        )
+    _verified_users.add(user_id)
 
 
 def verify_specific_user(user_id, phone_number):
     """Добавляет конкретного пользователя в базу данных верифицированных пользователей"""
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR IGNORE INTO verified_users (user_id, phone_number) VALUES (?, ?)",
+            (user_id, phone_number),
+        )
+        result = c.rowcount == 1
+    _verified_users.add(user_id)
+    return result
+
+
+def load_known_users():
+    """Загружает id всех пользователей из users, чтобы /start не ходил в базу"""
+    global _known_users
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT user_id FROM users ORDER BY user_id")
+        _known_users = UserIdSet(row[0] for row in c)
+
+
+def add_users(user_ids):
+    """
+    Добавляет пачку пользователей в таблицу users одной транзакцией.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+            ((user_id,) for user_id in user_ids),
+        )
+
+
+_new_users = WriteBehindBuffer(add_users, USER_FLUSH_INTERVAL, USER_FLUSH_BATCH)
+
+
+def register_user(user_id):
+    """
+    Регистрирует пользователя без обращения к диску: уже известные id
+    отсекаются по памяти, новые ставятся в очередь на пакетную запись.
+    """
+    if user_id in _known_users:
+        return
+    _known_users.add(user_id)
+    _new_users.add(user_id)
+
+
+def set_users_blocked(changes):
+    """
+    Применяет пачку изменений доступности [(user_id, blocked)] одной
+    транзакцией в порядке поступления. blocked=True — пользователь
+    заблокировал бота или удалил аккаунт, False — снова доступен.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "UPDATE users SET blocked_at = CASE WHEN ? THEN COALESCE(blocked_at, CURRENT_TIMESTAMP) END "
+            "WHERE user_id = ?",
+            ((blocked, user_id) for user_id, blocked in changes),
+        )
+
+
+_blocked_changes = WriteBehindBuffer(set_users_blocked, USER_FLUSH_INTERVAL, USER_FLUSH_BATCH)
+
+
+def touch_users(user_ids):
+    """Обновляет last_seen_at пачки пользователей одной транзакцией"""
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "UPDATE users SET last_seen_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+            ((user_id,) for user_id in user_ids),
+        )
+
+
+_seen_users = WriteBehindBuffer(touch_users, USER_FLUSH_INTERVAL, USER_FLUSH_BATCH)
+_seen_window = None
+_seen_in_window = set()
+
+
+async def track_activity(update, context):
+    """
+    Отмечает активность пользователя для сегментов «активные за N дней».
+    В базу попадает не больше одной отметки на пользователя за
+    ACTIVITY_RESOLUTION секунд.
+    """
+    global _seen_window
+    user = update.effective_user
+    if not user:
+        return
+    window = int(time.time() // ACTIVITY_RESOLUTION)
+    if window != _seen_window:
+        _seen_window = window
+        _seen_in_window.clear()
+    if user.id in _seen_in_window:
+        return
+    _seen_in_window.add(user.id)
+    _seen_users.add(user.id)
+
+
+def get_audience_counts():
+    """Возвращает (всего пользователей, из них доступны для рассылки)"""
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM users")
+        total = c.fetchone()[0]
+        c.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL")
+        reachable = c.fetchone()[0]
+    return total, reachable
+
+
+async def track_bot_membership(update, context):
+    """
+    Отмечает блокировку и разблокировку бота пользователем по апдейтам
+    my_chat_member, не дожидаясь ошибки при рассылке.
+    """
+    member_update = update.my_chat_member
+    if member_update.chat.type != "private":
+        return
+    user_id = member_update.chat.id
+    status = member_update.new_chat_member.status
+    if status == ChatMember.BANNED:
+        logger.info(f"User {user_id} blocked the bot")
+        _blocked_changes.add((user_id, True))
+    elif status == ChatMember.MEMBER:
+        logger.info(f"User {user_id} unblocked the bot")
+        register_user(user_id)
+        _blocked_changes.add((user_id, False))
+
+
+def set_channel_members(changes):
+    """
+    Применяет пачку статусов в канале [(user_id, status)] одной
+    транзакцией в порядке поступления: из апдейтов chat_member и из
+    свежих ответов getChatMember.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "INSERT INTO channel_members (user_id, status) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET status = excluded.status, "
+            "updated_at = CURRENT_TIMESTAMP",
+            changes,
+        )
+
+
+_channel_member_changes = WriteBehindBuffer(
+    set_channel_members, USER_FLUSH_INTERVAL, USER_FLUSH_BATCH
+)
 
-    c.execute("SELECT 1 FROM verified_users WHERE user_id = ?", (user_id,))
-    exists = c.fetchone() is not None
 
-    if not exists:
+def get_channel_member_status(user_id):
+    """
+    Статус подписчика по локальной таблице, если ему можно верить без
+    запроса: подписан и запись не старше CHANNEL_MEMBER_TTL. Иначе None —
+    пропущенный апдейт chat_member (простой бота) не должен навсегда
+    закрыть пользователю участие или пропустить отписавшегося.
+    """
+    with db.reader() as conn:
+        c = conn.cursor()
         c.execute(
-            "INSERT INTO verified_users (user_id, phone_number) VALUES (?, ?)",
-            (user_id, phone_number),
+            "SELECT status FROM channel_members WHERE user_id = ? "
+            "AND updated_at >= datetime('now', ?)",
+            (user_id, f"-{CHANNEL_MEMBER_TTL} seconds"),
         )
-        conn.commit()
-        result = True
-    else:
-        result = False
+        result = c.fetchone()
+    if result and result[0] in SUBSCRIBED_STATUSES:
+        return result[0]
+    return None
 
-    conn.close()
-    return result
 
-def add_user(user_id):
+async def track_channel_membership(update, context):
     """
-    Добавляет пользователя в таблицу users, если его еще нет.
+    Ведет локальную таблицу подписчиков канала по апдейтам chat_member:
+    бот — администратор канала и получает все вступления и выходы.
     """
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY)''')
-    c.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    member_update = update.chat_member
+    username = member_update.chat.username or ""
+    if f"@{username}".lower() != SUBSCRIPTION_CHANNEL.lower():
+        return
+    user_id = member_update.new_chat_member.user.id
+    status = member_update.new_chat_member.status
+    logger.info(f"User {user_id} channel status: {status}")
+    _channel_member_changes.add((user_id, status))
+    # Вступление или выход сразу заменяет закэшированный статус, не дожидаясь TTL.
+    _subscriptions.set(user_id, status)
+
 
 def get_all_users():
     """
-    Возвращает список всех user_id из таблицы users.
+    Возвращает список user_id из таблицы users, до которых бот может
+    достучаться: пользователи, заблокировавшие бота, пропускаются.
     """
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM users")
-    users = c.fetchall()
-    conn.close()
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT user_id FROM users WHERE blocked_at IS NULL")
+        users = c.fetchall()
     return [user[0] for user in users]
 
+
+def _audience_query(columns, segment):
+    """
+    SQL выборки доступных пользователей. segment — необязательный сегмент
+    аудитории {"name", "contest_id"} (см. audience_spec); условие по нему
+    строит audience_segment.
+    """
+    where, params = "", ()
+    if segment:
+        where, params = audience_segment(segment["name"], segment["contest_id"]) or (where, params)
+    sql = f"SELECT {columns} FROM users WHERE blocked_at IS NULL"
+    if where:
+        sql += f" AND ({where})"
+    return sql, tuple(params)
+
+
+def get_audience_page(conn, after_user_id, segment=None, limit=AUDIENCE_PAGE_SIZE):
+    """Следующая страница аудитории после after_user_id (keyset-пагинация)"""
+    sql, params = _audience_query("user_id", segment)
+    c = conn.cursor()
+    c.execute(
+        f"{sql} AND user_id > ? ORDER BY user_id LIMIT ?",
+        params + (after_user_id, limit),
+    )
+    return [row[0] for row in c.fetchall()]
+
+
+def count_audience(segment=None):
+    sql, params = _audience_query("COUNT(*)", segment)
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(sql, params)
+        return c.fetchone()[0]
+
+
 def validate_date(date_str):
     try:
         datetime.strptime(date_str, "%d.%m.%Y")
@@ -174,114 +858,156 @@ def format_post_preview(title, text):
 
 
 def add_admin(user_id):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    with _admin_lock:
+        with db.writer() as conn:
+            c = conn.cursor()
+            c.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+        _admin_ids.add(user_id)
 
 
 def remove_admin(user_id):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with _admin_lock:
+        with db.writer() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+        _admin_ids.discard(user_id)
 
 
-def create_contest(photo_id, title, end_date):
-    conn = sqlite3.connect("bazumi_bot.db")
+def _load_active_contest(conn):
+    """
+    Перечитывает активный конкурс в кэш. Вызывается на соединении-писателе
+    сразу после изменения contests, поэтому кэш меняется в порядке записей.
+    """
+    global _active_contest
     c = conn.cursor()
     c.execute(
-        "INSERT INTO contests (photo_id, title, end_date) VALUES (?, ?, ?)",
-        (photo_id, title, end_date),
+        "SELECT id, photo_id, title, end_date, status, message_id "
+        "FROM contests WHERE status = 'active' LIMIT 1"
     )
-    contest_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    row = c.fetchone()
+    _active_contest = Contest(*row) if row else None
+
+
+def create_contest(photo_id, title, end_date):
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO contests (photo_id, title, end_date) VALUES (?, ?, ?)",
+            (photo_id, title, end_date),
+        )
+        contest_id = c.lastrowid
+        _load_active_contest(conn)
     return contest_id
 
 
 def get_active_contest():
     """
-    Возвращает данные активного конкурса из базы данных.
-    Ожидаемый формат: (id, photo_id, title, end_date, status, message_id).
+    Возвращает активный конкурс (Contest) из кэша или None.
+    Кэш обновляют create_contest, update_contest, set_contest_message_id
+    и delete_contest_db.
     """
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute("SELECT * FROM contests WHERE status = 'active' LIMIT 1")
-    contest = c.fetchone()
-    conn.close()
-    return contest
+    return _active_contest
 
 
 def update_contest(contest_id, photo_id, title, end_date):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute(
-        "UPDATE contests SET photo_id = ?, title = ?, end_date = ? WHERE id = ?",
-        (photo_id, title, end_date, contest_id),
-    )
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE contests SET photo_id = ?, title = ?, end_date = ? WHERE id = ?",
+            (photo_id, title, end_date, contest_id),
+        )
+        _load_active_contest(conn)
+
+
+def get_contest_message_id(contest_id):
+    """Возвращает message_id публикации конкурса в канале или None"""
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT message_id FROM contests WHERE id = ?", (contest_id,))
+        result = c.fetchone()
+    return result[0] if result else None
+
+
+def set_contest_message_id(contest_id, message_id):
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE contests SET message_id = ? WHERE id = ?",
+            (message_id, contest_id),
+        )
+        _load_active_contest(conn)
 
 
 def delete_contest_db(contest_id):
     """Удаляет конкурс из базы данных"""
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute("UPDATE contests SET status = 'inactive' WHERE id = ?", (contest_id,))
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE contests SET status = 'inactive' WHERE id = ?", (contest_id,))
+        _load_active_contest(conn)
 
 
 def add_participant(contest_id, user_id, username, phone_number):
     """Добавляет участника конкурса в базу данных"""
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute(
-        "INSERT OR IGNORE INTO participants (contest_id, user_id, username, phone_number) VALUES (?, ?, ?, ?)",
-        (contest_id, user_id, username, phone_number),
-    )
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR IGNORE INTO participants (contest_id, user_id, username, phone_number) VALUES (?, ?, ?, ?)",
+            (contest_id, user_id, username, phone_number),
+        )
+
+
+def register_participant(contest_id, user_id, username, phone_number):
+    """
+    Верифицирует пользователя и записывает его в участники конкурса одной
+    транзакцией. Возвращает True, если участник добавлен впервые.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO verified_users (user_id, phone_number) VALUES (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET phone_number = excluded.phone_number",
+            (user_id, phone_number),
+        )
+        c.execute(
+            "INSERT OR IGNORE INTO participants (contest_id, user_id, username, phone_number) VALUES (?, ?, ?, ?)",
+            (contest_id, user_id, username, phone_number),
+        )
+        added = c.rowcount == 1
+    _verified_users.add(user_id)
+    return added
 
 
 def get_participants(contest_id):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute(
-        "SELECT username, phone_number FROM participants WHERE contest_id = ?",
-        (contest_id,),
-    )
-    participants = c.fetchall()
-    conn.close()
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT username, phone_number, subscribed FROM participants WHERE contest_id = ?",
+            (contest_id,),
+        )
+        participants = c.fetchall()
     return participants
 
 
 def is_participant(contest_id, user_id):
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute(
-        "SELECT 1 FROM participants WHERE contest_id = ? AND user_id = ?",
-        (contest_id, user_id),
-    )
-    result = c.fetchone() is not None
-    conn.close()
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT 1 FROM participants WHERE contest_id = ? AND user_id = ?",
+            (contest_id, user_id),
+        )
+        result = c.fetchone() is not None
     return result
 
 
 def create_post(photo_id, title, text):
     """Создает новый пост в базе данных"""
-    conn = sqlite3.connect("bazumi_bot.db")
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO posts (photo_id, title, text) VALUES (?, ?, ?)",
-        (photo_id, title, text),
-    )
-    post_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO posts (photo_id, title, text) VALUES (?, ?, ?)",
+            (photo_id, title, text),
+        )
+        post_id = c.lastrowid
     return post_id
 
 
@@ -300,19 +1026,65 @@ CREATE_POST_PHOTO, CREATE_POST_TITLE, CREATE_POST_TEXT, CREATE_POST_PREVIEW = ra
 PARTICIPATE_CONFIRM = 12
 VERIFY_SUPPORT = 13  
 VERIFY_VIDEOS = 14  
+SCHEDULE_POST_TIME = 15
+SCHEDULE_CONTEST_TIME = 16
+SCHEDULE_POST_AUDIENCE = 17
+SCHEDULE_CONTEST_AUDIENCE = 18
 
-async def admin_panel(update, context):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("У вас нет доступа к админ-панели.")
-        return
-    keyboard = [
+
+async def admin_panel_text():
+    """Заголовок админ-панели с текущим размером аудитории рассылок"""
+    await _new_users.flush()
+    await _blocked_changes.flush()
+    total, reachable = await db.call(get_audience_counts)
+    text = (
+        "Административная панель:\n"
+        f"Пользователей: {total}, доступны для рассылки: {reachable}, "
+        f"заблокировали бота: {total - reachable}"
+    )
+    text += (
+        f"\nПроверки подписки: из кэша {_subscriptions.hits}, "
+        f"из таблицы канала {_subscriptions.local_hits}, "
+        f"запросов к Telegram {_subscriptions.api_calls}"
+    )
+    recent = await db.call(get_recent_broadcast_stats)
+    if recent:
+        text += "\n\nПоследние рассылки:\n" + "\n".join(
+            format_broadcast_report(row) for row in recent
+        )
+    return text
+
+
+def admin_panel_keyboard():
+    return [
         [InlineKeyboardButton("Конкурс", callback_data="contest")],
         [InlineKeyboardButton("Пост", callback_data="post")],
+        [InlineKeyboardButton("Рассылки", callback_data="broadcasts")],
     ]
+
+
+def contest_menu_keyboard():
+    return [
+        [InlineKeyboardButton("Создать новый конкурс", callback_data="create_contest")],
+        [InlineKeyboardButton("Редактировать текущий конкурс", callback_data="edit_contest")],
+        [InlineKeyboardButton("Удалить текущий конкурс", callback_data="delete_contest")],
+        [InlineKeyboardButton("Уведомление о текущем конкурсе", callback_data="notify_contest")],
+        [InlineKeyboardButton("Запланировать уведомление", callback_data="schedule_contest")],
+        [InlineKeyboardButton("Выгрузить участников", callback_data="export_participants")],
+        [InlineKeyboardButton("Проверить подписки участников", callback_data="recheck_participants")],
+        [InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")],
+    ]
+
+
+async def admin_panel(update, context):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет доступа к админ-панели.")
+        return
+    keyboard = admin_panel_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
     try:
         await update.message.reply_text(
-            "Административная панель:", reply_markup=reply_markup
+            await admin_panel_text(), reply_markup=reply_markup
         )
     except NetworkError:
         await update.message.reply_text(
@@ -330,14 +1102,11 @@ async def back_to_admin_panel(update, context):
     if not is_admin(update.effective_user.id):
         await query.edit_message_text("У вас нет доступа к админ-панели.")
         return
-    keyboard = [
-        [InlineKeyboardButton("Конкурс", callback_data="contest")],
-        [InlineKeyboardButton("Пост", callback_data="post")],
-    ]
+    keyboard = admin_panel_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
     try:
         await query.edit_message_text(
-            "Административная панель:", reply_markup=reply_markup
+            await admin_panel_text(), reply_markup=reply_markup
         )
     except NetworkError:
         await query.edit_message_text(
@@ -352,30 +1121,7 @@ async def back_to_admin_panel(update, context):
 async def contest_menu(update, context):
     query = update.callback_query
     await query.answer()
-    keyboard = [
-        [InlineKeyboardButton("Создать новый конкурс", callback_data="create_contest")],
-        [
-            InlineKeyboardButton(
-                "Редактировать текущий конкурс", callback_data="edit_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Удалить текущий конкурс", callback_data="delete_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Уведомление о текущем конкурсе", callback_data="notify_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Выгрузить участников", callback_data="export_participants"
-            )
-        ],
-        [InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")], 
-    ]
+    keyboard = contest_menu_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text("Управление конкурсом:", reply_markup=reply_markup)
 
@@ -529,7 +1275,8 @@ async def create_contest_preview(update, context):
 
     if query.data == "publish_contest":
         try:
-            contest_id = create_contest(
+            contest_id = await db.call(
+                create_contest,
                 context.user_data["contest_photo"],
                 context.user_data["contest_title"],
                 context.user_data["contest_date"],
@@ -554,14 +1301,7 @@ async def create_contest_preview(update, context):
                 reply_markup=reply_markup,
                 parse_mode="HTML",
             )
-            conn = sqlite3.connect("bazumi_bot.db")
-            c = conn.cursor()
-            c.execute(
-                "UPDATE contests SET message_id = ? WHERE id = ?",
-                (sent_message.message_id, contest_id),
-            )
-            conn.commit()
-            conn.close()
+            await db.call(set_contest_message_id, contest_id, sent_message.message_id)
 
             await context.bot.send_message(
                 chat_id=update.effective_chat.id, text="Конкурс опубликован!"
@@ -571,40 +1311,7 @@ async def create_contest_preview(update, context):
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Управление конкурсом:",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "Создать новый конкурс", callback_data="create_contest"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Редактировать текущий конкурс",
-                                callback_data="edit_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Удалить текущий конкурс",
-                                callback_data="delete_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Уведомление о текущем конкурсе",
-                                callback_data="notify_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Выгрузить участников",
-                                callback_data="export_participants",
-                            )
-                        ],
-                        [InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")], 
-                    ]
-                ),
+                reply_markup=InlineKeyboardMarkup(contest_menu_keyboard()),
             )
         except Exception as e:
             logger.error(f"Error publishing contest: {e}")
@@ -616,40 +1323,7 @@ async def create_contest_preview(update, context):
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Управление конкурсом:",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "Создать новый конкурс", callback_data="create_contest"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Редактировать текущий конкурс",
-                                callback_data="edit_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Удалить текущий конкурс",
-                                callback_data="delete_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Уведомление о текущем конкурсе",
-                                callback_data="notify_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Выгрузить участников",
-                                callback_data="export_participants",
-                            )
-                        ],
-                        [InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")], 
-                    ]
-                ),
+                reply_markup=InlineKeyboardMarkup(contest_menu_keyboard()),
             )
     elif query.data == "edit_contest_preview":
         await context.bot.send_message(
@@ -670,7 +1344,7 @@ async def start_edit_contest(update, context):
         )
         return ConversationHandler.END
 
-    context.user_data["contest_id"] = contest[0]
+    context.user_data["contest_id"] = contest.id
 
     await update.callback_query.answer()
     await update.callback_query.edit_message_text("Загрузите новое фото для конкурса.")
@@ -799,7 +1473,7 @@ async def edit_contest_preview(update, context):
             if "contest_id" not in context.user_data:
                 contest = get_active_contest()
                 if contest:
-                    context.user_data["contest_id"] = contest[0]
+                    context.user_data["contest_id"] = contest.id
                 else:
                     logger.error("No active contest found for editing.")
                     await context.bot.send_message(
@@ -810,24 +1484,18 @@ async def edit_contest_preview(update, context):
                     await show_contest_menu(update, context)
                     return ConversationHandler.END
 
-            update_contest(
+            await db.call(
+                update_contest,
                 context.user_data["contest_id"],
                 context.user_data["contest_photo"],
                 context.user_data["contest_title"],
                 context.user_data["contest_date"],
             )
 
-            conn = sqlite3.connect("bazumi_bot.db")
-            c = conn.cursor()
-            c.execute(
-                "SELECT message_id FROM contests WHERE id = ?",
-                (context.user_data["contest_id"],),
-            )
-            result = c.fetchone()
-            conn.close()
+            message_id = await db.call(get_contest_message_id, context.user_data["contest_id"])
 
             logger.info(
-                f"Retrieved message_id from DB for contest {context.user_data['contest_id']}: {result}"
+                f"Retrieved message_id from DB for contest {context.user_data['contest_id']}: {message_id}"
             )
 
             preview = format_contest_preview(
@@ -842,8 +1510,7 @@ async def edit_contest_preview(update, context):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
-            if result and result[0]:
-                message_id = result[0]
+            if message_id:
                 logger.info(
                     f"Attempting to edit message with message_id: {message_id} in chat @BAZUMI_discountt"
                 )
@@ -880,14 +1547,10 @@ async def edit_contest_preview(update, context):
                     reply_markup=reply_markup,
                     parse_mode="HTML",
                 )
-                conn = sqlite3.connect("bazumi_bot.db")
-                c = conn.cursor()
-                c.execute(
-                    "UPDATE contests SET message_id = ? WHERE id = ?",
-                    (sent_message.message_id, context.user_data["contest_id"]),
+                await db.call(
+                    set_contest_message_id,
+                    context.user_data["contest_id"], sent_message.message_id
                 )
-                conn.commit()
-                conn.close()
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id, text="Конкурс обновлен, но оригинальное сообщение не найдено. Опубликовано новое.",
                 )
@@ -896,40 +1559,7 @@ async def edit_contest_preview(update, context):
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Управление конкурсом:",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "Создать новый конкурс", callback_data="create_contest"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Редактировать текущий конкурс",
-                                callback_data="edit_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Удалить текущий конкурс",
-                                callback_data="delete_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Уведомление о текущем конкурсе",
-                                callback_data="notify_contest",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "Выгрузить участников",
-                                callback_data="export_participants",
-                            )
-                        ],
-                        [InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")], 
-                    ]
-                ),
+                reply_markup=InlineKeyboardMarkup(contest_menu_keyboard()),
             )
         except Exception as e:
             logger.error(f"Error updating contest: {e}")
@@ -952,11 +1582,11 @@ async def delete_contest(update, context):
         await query.edit_message_text("Нет активных конкурсов для удаления.")
         return
 
-    context.user_data["contest_id"] = contest[0]
-    context.user_data["contest_title"] = contest[2]
+    context.user_data["contest_id"] = contest.id
+    context.user_data["contest_title"] = contest.title
 
     await query.edit_message_text(
-        f"Уверены, что хотите удалить конкурс {contest[2]}?",
+        f"Уверены, что хотите удалить конкурс {contest.title}?",
         reply_markup=InlineKeyboardMarkup(
             [
                 [InlineKeyboardButton("Да", callback_data="confirm_delete")],
@@ -980,16 +1610,11 @@ async def confirm_delete(update, context):
         return
 
     try:
-        conn = sqlite3.connect("bazumi_bot.db")
-        c = conn.cursor()
-        c.execute("SELECT message_id FROM contests WHERE id = ?", (contest_id,))
-        result = c.fetchone()
-        conn.close()
+        message_id = await db.call(get_contest_message_id, contest_id)
 
-        logger.info(f"Retrieved message_id for contest {contest_id}: {result}")
+        logger.info(f"Retrieved message_id for contest {contest_id}: {message_id}")
 
-        if result and result[0]:
-            message_id = result[0]
+        if message_id:
             logger.info(
                 f"Attempting to delete message {message_id} from channel @BAZUMI_discountt"
             )
@@ -1005,7 +1630,7 @@ async def confirm_delete(update, context):
                     text=f"Предупреждение: не удалось удалить сообщение из канала: {str(delete_error)}. Конкурс будет удален из базы данных.",
                 )
 
-        delete_contest_db(contest_id)
+        await db.call(delete_contest_db, contest_id)
         logger.info(f"Contest {contest_id} successfully removed from database.")
 
         await query.edit_message_text("Конкурс успешно удален.")
@@ -1027,61 +1652,1070 @@ async def cancel_delete(update, context):
     if "contest_title" in context.user_data:
         del context.user_data["contest_title"]
 
-    keyboard = [
-        [InlineKeyboardButton("Создать новый конкурс", callback_data="create_contest")],
-        [
-            InlineKeyboardButton(
-                "Редактировать текущий конкурс", callback_data="edit_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Удалить текущий конкурс", callback_data="delete_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Уведомление о текущем конкурсе", callback_data="notify_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Выгрузить участников", callback_data="export_participants"
-            )
-        ],
-        [InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")],
-    ]
+    keyboard = contest_menu_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text("Управление конкурсом:", reply_markup=reply_markup)
 
-async def notify_all_users(contest, context):
+
+class TokenBucket:
     """
-    Отправляет уведомление о конкурсе всем пользователям из базы данных.
+    Асинхронный token bucket: rate токенов в секунду, запас не больше capacity.
+    По умолчанию запас в один токен, то есть ровный темп без всплесков:
+    Telegram считает лимит по скользящему окну и наказывает за пачки.
+    pause() останавливает выдачу токенов, например после RetryAfter от Telegram.
     """
-    users = get_all_users()
-    if not users:
-        logger.warning("Список пользователей пуст.")
-        return
-    
-    notification = format_contest_notification(contest[2], contest[3])
-    keyboard = [[InlineKeyboardButton("Принять участие в конкурсе", callback_data="participate")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    for user_id in users:
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Классы приоритета исходящих сообщений: меньше — важнее.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Единый планировщик исходящих запросов к Bot API. Все сообщения бота
+    (send*, edit*, copy*, forward*) проходят через общий token bucket на
+    overall_rate в секунду и через bucket своего чата (для личных чатов
+    запас на всплеск больше, чем для групп и каналов); очередь к общему
+    bucket разбирается по приоритету:
+    ответы пользователям, затем админ-панель, затем массовые рассылки.
+    Общий bucket задает и темп рассылок. Приоритет передается через
+    rate_limit_args={"priority": ...}, иначе определяется по чату.
+    Остальные методы (answerCallbackQuery, getChatMember...) не ждут.
+    """
+
+    def __init__(
+        self,
+        overall_rate=OUTBOUND_RATE,
+        private_chat_rate=PRIVATE_CHAT_RATE,
+        private_chat_burst=PRIVATE_CHAT_BURST,
+        group_chat_rate=GROUP_CHAT_RATE,
+        group_chat_burst=GROUP_CHAT_BURST,
+        max_retries=BROADCAST_MAX_RETRIES,
+    ):
+        self.overall_rate = overall_rate
+        self.private_chat_rate = private_chat_rate
+        self.private_chat_burst = private_chat_burst
+        self.group_chat_rate = group_chat_rate
+        self.group_chat_burst = group_chat_burst
+        self.max_retries = max_retries
+        self._bucket = None
+        self._chat_buckets = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+    async def initialize(self):
+        self._bucket = TokenBucket(self.overall_rate)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    @staticmethod
+    def _is_message(endpoint):
+        return endpoint.startswith(("send", "edit", "copy", "forward"))
+
+    @staticmethod
+    def _priority(data, rate_limit_args):
+        if rate_limit_args and "priority" in rate_limit_args:
+            return rate_limit_args["priority"]
+        chat_id = data.get("chat_id")
+        if isinstance(chat_id, int) and is_admin(chat_id):
+            return PRIORITY_ADMIN
+        return PRIORITY_INTERACTIVE
+
+    @staticmethod
+    def _is_group_chat(chat_id):
+        # У групп и каналов отрицательный id, канал можно указать и по @имени.
+        if isinstance(chat_id, str):
+            return chat_id.startswith("@") or chat_id.startswith("-")
+        return isinstance(chat_id, int) and chat_id < 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= CHAT_BUCKETS_LIMIT:
+                # Бакеты, которые успели наполниться, ничем не отличаются от новых.
+                now = time.monotonic()
+                for key, old in list(self._chat_buckets.items()):
+                    if now - old._updated > old.capacity / old.rate:
+                        del self._chat_buckets[key]
+            if self._is_group_chat(chat_id):
+                bucket = TokenBucket(self.group_chat_rate, self.group_chat_burst)
+            else:
+                bucket = TokenBucket(self.private_chat_rate, self.private_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._waiting:
+                await self._bucket.acquire()
+                while self._waiting:
+                    future = heapq.heappop(self._waiting)[2]
+                    if not future.done():
+                        future.set_result(None)
+                        break
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not self._is_message(endpoint):
+            return await callback(*args, **kwargs)
+        priority = self._priority(data, rate_limit_args)
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            await self._acquire(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = _retry_after_seconds(e)
+                self._bucket.pause(delay)
+                # Рассылка сама считает повторы и ставит на паузу свой bucket.
+                if priority == PRIORITY_BULK or attempt == self.max_retries:
+                    raise
+                logger.warning(f"{endpoint} hit flood limit, retrying in {delay}s")
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик апдейтов для Application: апдейты разных пользователей идут
+    параллельно, поэтому медленный запрос к базе или Bot API у одного
+    пользователя не задерживает остальных. Апдейты одного пользователя
+    обрабатываются строго по очереди, как без concurrent_updates: на этом
+    держатся ConversationHandler и context.user_data.
+    """
+
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        # user_id -> [lock, число апдейтов, ждущих или держащих lock]
+        self._locks = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await coroutine
+            return
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
         try:
-            await context.bot.send_photo(
-                chat_id=user_id,
-                photo=contest[1], 
-                caption=notification,
-                reply_markup=reply_markup,
-                parse_mode='HTML'
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+
+
+class BroadcastStats:
+    """Счетчики одной рассылки"""
+
+    def __init__(self, total=0):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        # Из failed: заблокировали бота или удалили аккаунт.
+        self.unreachable = 0
+        # Повторные попытки; из них rate_limited — после RetryAfter от Telegram.
+        self.retried = 0
+        self.rate_limited = 0
+        # Отправлено до перезапуска: не входит в текущую скорость.
+        self.sent_before = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def processed(self):
+        return self.sent + self.failed
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self):
+        sent = self.sent - self.sent_before
+        return sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        return (
+            f"sent={self.sent} failed={self.failed} unreachable={self.unreachable} "
+            f"retried={self.retried} rate_limited={self.rate_limited} "
+            f"total={self.total} elapsed={self.elapsed:.1f}s rate={self.rate:.1f} msg/s"
+        )
+
+
+# Итоги отправки одному получателю и виды ошибок.
+SEND_OK = "ok"
+SEND_FAILED = "failed"
+SEND_UNREACHABLE = "unreachable"
+SEND_RETRY_AFTER = "retry_after"
+SEND_TRANSIENT = "transient"
+
+# Ответы BadRequest, после которых писать пользователю бессмысленно.
+UNREACHABLE_MESSAGES = (
+    "chat not found",
+    "user is deactivated",
+    "peer_id_invalid",
+    "bot can't initiate conversation",
+)
+
+
+def classify_send_error(error):
+    """
+    Определяет, что делать с ошибкой отправки: повторить после паузы
+    (RetryAfter), повторить сразу (сетевые сбои), пометить пользователя
+    недоступным или просто засчитать ошибку.
+    """
+    if isinstance(error, RetryAfter):
+        return SEND_RETRY_AFTER
+    if isinstance(error, Forbidden):
+        return SEND_UNREACHABLE
+    # BadRequest наследует NetworkError, но повтор его не исправит.
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        if any(marker in message for marker in UNREACHABLE_MESSAGES):
+            return SEND_UNREACHABLE
+        return SEND_FAILED
+    if isinstance(error, (TimedOut, NetworkError)):
+        return SEND_TRANSIENT
+    return SEND_FAILED
+
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+async def broadcast(
+    user_ids,
+    send,
+    rate=BROADCAST_RATE,
+    concurrency=BROADCAST_CONCURRENCY,
+    stats=None,
+    on_result=None,
+):
+    """
+    Рассылает сообщение пользователям из user_ids — списка или асинхронного
+    итератора (см. iter_job_recipients), который читается по мере отправки.
+
+    send(user_id) — корутина, отправляющая одно сообщение. Одновременно
+    выполняется не больше concurrency отправок, общий темп ограничен rate
+    сообщений в секунду; rate=None — темп задает PriorityRateLimiter бота.
+    RetryAfter приостанавливает всю рассылку на время, указанное Telegram,
+    после чего сообщение отправляется повторно.
+    on_result(user_id, outcome) вызывается с итогом по каждому получателю:
+    SEND_OK, SEND_FAILED или SEND_UNREACHABLE.
+    """
+    if stats is None:
+        stats = BroadcastStats()
+    bucket = TokenBucket(rate) if rate else None
+    pending = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def deliver(user_id):
+        outcome = SEND_FAILED
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            if bucket:
+                await bucket.acquire()
+            try:
+                await send(user_id)
+                outcome = SEND_OK
+                break
+            except Exception as e:
+                kind = classify_send_error(e)
+                if kind == SEND_RETRY_AFTER:
+                    delay = _retry_after_seconds(e)
+                    logger.warning(f"Broadcast hit flood limit, pausing for {delay}s")
+                    if bucket:
+                        bucket.pause(delay)
+                    stats.retried += 1
+                    stats.rate_limited += 1
+                elif kind == SEND_TRANSIENT:
+                    logger.warning(f"Network error sending to {user_id}, retrying: {e}")
+                    stats.retried += 1
+                else:
+                    if kind == SEND_UNREACHABLE:
+                        logger.info(f"User {user_id} is unreachable: {e}")
+                    else:
+                        logger.error(f"Ошибка при отправке рассылки пользователю {user_id}: {e}")
+                    outcome = kind
+                    break
+        if outcome == SEND_OK:
+            stats.sent += 1
+        else:
+            stats.failed += 1
+            if outcome == SEND_UNREACHABLE:
+                stats.unreachable += 1
+        if on_result:
+            on_result(user_id, outcome)
+
+    async def worker():
+        while True:
+            user_id = await pending.get()
+            if user_id is None:
+                return
+            await deliver(user_id)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        if hasattr(user_ids, "__aiter__"):
+            async for user_id in user_ids:
+                await pending.put(user_id)
+        else:
+            for user_id in user_ids:
+                await pending.put(user_id)
+        for _ in workers:
+            await pending.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        stats.finished_at = time.monotonic()
+    return stats
+
+
+class AudienceSnapshot:
+    """
+    Замороженная аудитория рассылки: user_id по возрастанию в array('q')
+    (8 байт на получателя) и рядом битовая карта обработанных (1 бит).
+    С path снимок хранится в файлах path.ids и path.done, чтобы рассылку
+    можно было продолжить после перезапуска. Загруженный с use_mmap снимок
+    читает path.ids через mmap без копирования в память процесса, и этот же
+    файл могут открыть другие процессы.
+
+    append и отметки из checkpoint выполняются в разных потоках БД, поэтому
+    массивы меняются только под _lock.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.ids = array("q")
+        self.done = bytearray()
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def last_id(self):
+        return self.ids[-1] if len(self.ids) else 0
+
+    def append(self, user_ids):
+        """Дописывает страницу user_id, которые больше уже сохраненных"""
+        if self._mmap is not None:
+            raise ValueError("Снимок, открытый через mmap, только для чтения")
+        chunk = array("q", user_ids)
+        if self.path:
+            with open(self.path + ".ids", "ab") as f:
+                chunk.tofile(f)
+        with self._lock:
+            self.ids.extend(chunk)
+            self.done.extend(bytes((len(self.ids) + 7) // 8 - len(self.done)))
+
+    def mark_done(self, user_ids):
+        """Отмечает обработанными user_id из пачки"""
+        with self._lock:
+            for user_id in user_ids:
+                i = bisect_left(self.ids, user_id)
+                if i < len(self.ids) and self.ids[i] == user_id:
+                    self.done[i >> 3] |= 1 << (i & 7)
+
+    def is_done(self, i):
+        return bool(self.done[i >> 3] & (1 << (i & 7)))
+
+    def pending(self):
+        """Отдает user_id, которые еще не отмечены обработанными"""
+        for i in range(len(self.ids)):
+            if not self.is_done(i):
+                yield self.ids[i]
+
+    def save_done(self):
+        """Атомарно перезаписывает файл битовой карты"""
+        if not self.path:
+            return
+        with self._lock:
+            done = bytes(self.done)
+        # Свое имя временного файла на каждую запись: две одновременные
+        # записи не удалят файл друг у друга.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or ".",
+            prefix=os.path.basename(self.path) + ".done.",
+            suffix=".tmp",
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(done)
+            os.replace(tmp_path, self.path + ".done")
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def nbytes(self):
+        if self._mmap is not None:
+            return len(self.done)
+        return self.ids.itemsize * len(self.ids) + len(self.done)
+
+    @classmethod
+    def load(cls, path, last_id=None, use_mmap=False, has_progress=False):
+        """
+        Открывает сохраненный снимок. Записи после last_id (страница,
+        дописанная в файл, но не отмеченная в базе) отбрасываются.
+        FileNotFoundError, если файлов нет, хотя по базе они должны быть:
+        last_id — в снимке есть страницы, has_progress — есть отметки.
+        Пустой снимок вместо потерянного разослал бы всё повторно.
+        """
+        snapshot = cls(path)
+        ids_path = path + ".ids"
+        if last_id and not os.path.exists(ids_path):
+            raise FileNotFoundError(f"Audience snapshot {ids_path} is missing")
+        if has_progress and not os.path.exists(path + ".done"):
+            raise FileNotFoundError(f"Audience snapshot {path}.done is missing")
+        if os.path.exists(ids_path):
+            size = os.path.getsize(ids_path)
+            if use_mmap and size:
+                with open(ids_path, "rb") as f:
+                    snapshot._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                snapshot.ids = memoryview(snapshot._mmap)[: size - size % 8].cast("q")
+            else:
+                with open(ids_path, "rb") as f:
+                    snapshot.ids.fromfile(f, size // 8)
+        if last_id is not None and len(snapshot.ids) and snapshot.ids[-1] > last_id:
+            count = bisect_right(snapshot.ids, last_id)
+            if snapshot._mmap is not None:
+                snapshot.ids = snapshot.ids[:count]
+            else:
+                del snapshot.ids[count:]
+                with open(ids_path, "r+b") as f:
+                    f.truncate(count * 8)
+        if os.path.exists(path + ".done"):
+            with open(path + ".done", "rb") as f:
+                snapshot.done = bytearray(f.read())
+        size = (len(snapshot.ids) + 7) // 8
+        snapshot.done = snapshot.done[:size] + bytes(max(0, size - len(snapshot.done)))
+        return snapshot
+
+    def close(self):
+        if self._mmap is not None:
+            self.ids.release()
+            self._mmap.close()
+            self._mmap = None
+            self.ids = array("q")
+
+    def remove(self):
+        self.close()
+        if self.path:
+            for suffix in (".ids", ".done"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+
+def broadcast_snapshot_path(job_id):
+    os.makedirs(BROADCAST_SNAPSHOT_DIR, exist_ok=True)
+    return os.path.join(BROADCAST_SNAPSHOT_DIR, f"job_{job_id}")
+
+
+def create_broadcast_job(
+    title, payload, admin_chat_id, progress_message_id, total, segment=None, dedup_key=None
+):
+    """
+    Сохраняет задание рассылки. payload — словарь с содержимым сообщения
+    (см. make_broadcast_sender), segment — сегмент аудитории (см. audience_spec).
+    Снимок аудитории дописывается по ходу рассылки в snapshot_audience_page.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO broadcast_jobs "
+            "(title, payload, admin_chat_id, progress_message_id, total, segment, dedup_key) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                title, json.dumps(payload), admin_chat_id, progress_message_id,
+                total, json.dumps(segment), dedup_key,
+            ),
+        )
+        return c.lastrowid
+
+
+def snapshot_audience_page(job_id, snapshot, segment, limit=AUDIENCE_PAGE_SIZE):
+    """
+    Читает следующую страницу аудитории, дописывает ее в снимок задания и
+    сдвигает audience_cursor. Неполная страница означает, что снимок
+    собран целиком. Страница читается через читателя пула, чтобы не
+    держать блокировку записи, пока идет выборка.
+    """
+    with db.reader() as conn:
+        page = get_audience_page(conn, snapshot.last_id, segment, limit)
+    snapshot.append(page)
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE broadcast_jobs SET audience_cursor = ?, audience_complete = ? WHERE id = ?",
+            (snapshot.last_id, len(page) < limit, job_id),
+        )
+    return page
+
+
+def save_broadcast_checkpoint(job_id, snapshot, results):
+    """
+    Отмечает пачку результатов [(user_id, итог)] в битовой карте снимка,
+    сохраняет ее и прибавляет счетчики задания.
+    """
+    snapshot.mark_done(user_id for user_id, _ in results)
+    snapshot.save_done()
+    sent = sum(1 for _, outcome in results if outcome == SEND_OK)
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+            (sent, len(results) - sent, job_id),
+        )
+
+
+def save_broadcast_stats(job_id, stats, status=None):
+    """
+    Записывает итоговые счетчики задания одним запросом. Время работы
+    прибавляется к уже сохраненному: рассылка могла идти в несколько
+    запусков бота. Со status задание заодно помечается завершенным.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE broadcast_jobs SET unreachable = ?, rate_limited = ?, retried = ?, "
+            "elapsed = elapsed + ? WHERE id = ?",
+            (stats.unreachable, stats.rate_limited, stats.retried, stats.elapsed, job_id),
+        )
+        if status:
+            c.execute(
+                "UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (status, job_id),
             )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
-            
+
+
+def get_recent_broadcast_stats(limit=3):
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id, title, status, total, sent, failed, unreachable, rate_limited, elapsed "
+            "FROM broadcast_jobs WHERE status != 'running' ORDER BY id DESC LIMIT ?",
+            (limit,),
+        )
+        return c.fetchall()
+
+
+def get_unfinished_broadcast_jobs():
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id, title, payload, admin_chat_id, progress_message_id, total, sent, failed, "
+            "segment, audience_cursor, audience_complete, dedup_key, unreachable, rate_limited, retried "
+            "FROM broadcast_jobs WHERE status = 'running' ORDER BY id"
+        )
+        return c.fetchall()
+
+
+async def iter_job_recipients(job, segment, complete=False):
+    """
+    Отдает получателей задания. Сначала — уже попавших в снимок, но еще
+    не обработанных (после перезапуска), затем снимок достраивается
+    страницами из базы, и каждая страница сразу уходит в рассылку.
+    """
+    for user_id in job.snapshot.pending():
+        yield user_id
+    while not complete:
+        page = await db.call(snapshot_audience_page, job.id, job.snapshot, segment)
+        for user_id in page:
+            yield user_id
+        complete = len(page) < AUDIENCE_PAGE_SIZE
+
+
+def make_broadcast_sender(bot, payload):
+    """Строит корутину send(user_id) по сохраненному содержимому рассылки"""
+    reply_markup = None
+    if payload.get("participate_button"):
+        reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Принять участие в конкурсе", callback_data="participate")]]
+        )
+
+    # Через PriorityRateLimiter рассылка идет в последнюю очередь.
+    extra = {}
+    if getattr(bot, "rate_limiter", None):
+        extra["rate_limit_args"] = {"priority": PRIORITY_BULK}
+
+    async def send(user_id):
+        await bot.send_photo(
+            chat_id=user_id,
+            photo=payload["photo"],
+            caption=payload["caption"],
+            reply_markup=reply_markup,
+            parse_mode='HTML',
+            **extra,
+        )
+
+    return send
+
+
+class BroadcastJob:
+    """
+    Рассылка, выполняемая в фоне: задача, счетчики, снимок аудитории и
+    сообщение с прогрессом. Результаты доставки копятся в checkpoint и
+    пачками отмечаются в снимке, чтобы после перезапуска продолжить
+    с необработанных получателей.
+    """
+
+    def __init__(self, job_id, title, stats, snapshot):
+        self.id = job_id
+        self.title = title
+        self.stats = stats
+        self.snapshot = snapshot
+        self.status = "running"
+        self.task = None
+        self.admin_chat_id = None
+        self.progress_message_id = None
+        self.cancel_requested = False
+        self.checkpoint = WriteBehindBuffer(
+            self.save_checkpoint, BROADCAST_CHECKPOINT_INTERVAL, BROADCAST_CHECKPOINT_BATCH
+        )
+
+    def save_checkpoint(self, results):
+        save_broadcast_checkpoint(self.id, self.snapshot, results)
+
+    def record(self, user_id, outcome):
+        self.checkpoint.add((user_id, outcome))
+        if outcome == SEND_UNREACHABLE:
+            _blocked_changes.add((user_id, True))
+
+
+_broadcast_jobs = {}
+# Ключ рассылки -> future с заданием, см. start_broadcast_job.
+_broadcast_dedup = {}
+
+BROADCAST_STATUS_TEXT = {
+    "running": "идет",
+    "done": "завершена",
+    "cancelled": "отменена",
+    "failed": "прервана ошибкой",
+}
+
+
+def format_broadcast_progress(job):
+    stats = job.stats
+    remaining = max(0, stats.total - stats.processed)
+    return (
+        f"Рассылка #{job.id} «{job.title}»: {BROADCAST_STATUS_TEXT[job.status]}\n"
+        f"Отправлено: {stats.sent}\n"
+        f"Ошибок: {stats.failed} (недоступны: {stats.unreachable})\n"
+        f"Лимит Telegram (повторы): {stats.rate_limited}\n"
+        f"Осталось: {remaining}\n"
+        f"Время: {stats.elapsed:.0f} с, скорость: {stats.rate:.1f} сообщ/с"
+    )
+
+
+def format_broadcast_report(row):
+    """Одна строка итогов завершенной рассылки для админ-панели"""
+    job_id, title, status, total, sent, failed, unreachable, rate_limited, elapsed = row
+    rate = sent / elapsed if elapsed > 0 else 0.0
+    return (
+        f"#{job_id} «{title}» ({BROADCAST_STATUS_TEXT[status]}): "
+        f"доставлено {sent} из {total}, недоступны {unreachable}, "
+        f"другие ошибки {failed - unreachable}, лимит {rate_limited}, "
+        f"{elapsed:.0f} с, {rate:.1f} сообщ/с"
+    )
+
+
+def broadcast_progress_markup(job):
+    if job.status != "running":
+        return None
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Отменить рассылку", callback_data=f"cancel_broadcast:{job.id}")]]
+    )
+
+
+async def update_broadcast_progress(bot, job):
+    try:
+        await bot.edit_message_text(
+            chat_id=job.admin_chat_id,
+            message_id=job.progress_message_id,
+            text=format_broadcast_progress(job),
+            reply_markup=broadcast_progress_markup(job),
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            logger.warning(f"Failed to update progress of broadcast {job.id}: {e}")
+    except Exception as e:
+        logger.warning(f"Failed to update progress of broadcast {job.id}: {e}")
+
+
+async def _report_broadcast_progress(bot, job):
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        await update_broadcast_progress(bot, job)
+
+
+async def _run_broadcast_job(bot, job, recipients, payload):
+    send = make_broadcast_sender(bot, payload)
+    # Через PriorityRateLimiter темп задает его общий bucket: второй
+    # bucket в broadcast() только занижал бы скорость рассылки.
+    rate = None if getattr(bot, "rate_limiter", None) else BROADCAST_RATE
+    reporter = asyncio.create_task(_report_broadcast_progress(bot, job))
+    checkpointer = asyncio.create_task(job.checkpoint.run())
+    try:
+        await broadcast(recipients, send, rate=rate, stats=job.stats, on_result=job.record)
+        job.status = "done"
+    except asyncio.CancelledError:
+        if not job.cancel_requested:
+            # Остановка бота: задание остается running и продолжится при запуске.
+            logger.info(f"Broadcast {job.id} interrupted by shutdown: {job.stats.summary()}")
+            raise
+        job.status = "cancelled"
+    except Exception as e:
+        logger.error(f"Broadcast {job.id} failed: {e}")
+        job.status = "failed"
+    finally:
+        reporter.cancel()
+        checkpointer.cancel()
+        # Дожидаемся остановки checkpointer, чтобы его сохранение не шло
+        # одновременно с последним.
+        await asyncio.gather(checkpointer, return_exceptions=True)
+        await job.checkpoint.flush()
+        if job.status == "running":
+            await db.call(save_broadcast_stats, job.id, job.stats)
+    await db.call(save_broadcast_stats, job.id, job.stats, job.status)
+    job.snapshot.remove()
+    logger.info(f"Broadcast {job.id} «{job.title}» {job.status}: {job.stats.summary()}")
+    await update_broadcast_progress(bot, job)
+
+
+def broadcast_dedup_key(payload, segment):
+    """Ключ рассылки по содержимому и аудитории"""
+    raw = json.dumps([payload, segment], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _register_broadcast_dedup(key, job_future):
+    for stale_key, future in list(_broadcast_dedup.items()):
+        if future.done() and not _is_duplicate_of(future.result()):
+            del _broadcast_dedup[stale_key]
+    _broadcast_dedup[key] = job_future
+
+
+def _is_duplicate_of(job):
+    if job is None or job.cancel_requested:
+        return False
+    if job.status == "running":
+        return True
+    # Окно отсчитывается от завершения рассылки, а не от ее запуска:
+    # иначе повтор долгой рассылки сразу после конца не был бы отсечен.
+    return (
+        job.status == "done"
+        and time.monotonic() - job.stats.finished_at < BROADCAST_DEDUP_WINDOW
+    )
+
+
+async def start_broadcast_job(bot, admin_chat_id, title, payload, segment=None):
+    """
+    Сохраняет задание рассылки, запускает его в фоне и сразу возвращает.
+    Аудитория читается из базы страницами по ходу рассылки. Администратор
+    получает сообщение с прогрессом, которое обновляется по ходу рассылки.
+    segment — сегмент аудитории (см. audience_spec), None — все пользователи.
+    Возвращает None, если в аудитории никого нет.
+
+    Повторный запуск той же рассылки (то же содержимое и аудитория), пока
+    она идет или в течение BROADCAST_DEDUP_WINDOW секунд после завершения,
+    ничего не отправляет: администратор получает прогресс уже запущенного
+    задания, и оно же возвращается.
+    """
+    key = broadcast_dedup_key(payload, segment)
+    while key in _broadcast_dedup:
+        job_future = _broadcast_dedup[key]
+        job = await asyncio.shield(job_future)
+        if _broadcast_dedup.get(key) is not job_future:
+            # Пока ждали, ту же рассылку успел запустить другой запрос.
+            continue
+        if not _is_duplicate_of(job):
+            break
+        logger.info(f"Duplicate broadcast «{title}» attached to job {job.id}")
+        await bot.send_message(
+            chat_id=admin_chat_id,
+            text="Эта рассылка уже запущена, повторно она не отправляется.\n\n"
+            + format_broadcast_progress(job),
+            reply_markup=broadcast_progress_markup(job),
+        )
+        return job
+
+    job_future = asyncio.get_running_loop().create_future()
+    _register_broadcast_dedup(key, job_future)
+    job = None
+    try:
+        job = await _launch_broadcast_job(bot, admin_chat_id, title, payload, segment, key)
+    finally:
+        job_future.set_result(job)
+    return job
+
+
+async def _launch_broadcast_job(bot, admin_chat_id, title, payload, segment, dedup_key):
+    await _new_users.flush()
+    await _blocked_changes.flush()
+    total = await db.call(count_audience, segment)
+    if not total:
+        logger.warning(f"Аудитория рассылки «{title}» пуста.")
+        return None
+    # Задание сохраняется только после того, как администратор получил
+    # сообщение о запуске: иначе ошибка отправки оставила бы в базе
+    # running-задание, которое запустилось бы само при следующем старте.
+    message = await bot.send_message(
+        chat_id=admin_chat_id,
+        text=f"Рассылка «{title}»: запускается, получателей: {total}",
+    )
+    job_id = await db.call(
+        create_broadcast_job, title, payload, admin_chat_id, message.message_id,
+        total, segment, dedup_key,
+    )
+    job = BroadcastJob(
+        job_id, title, BroadcastStats(total), AudienceSnapshot(broadcast_snapshot_path(job_id))
+    )
+    job.admin_chat_id = admin_chat_id
+    job.progress_message_id = message.message_id
+    _broadcast_jobs[job.id] = job
+    await update_broadcast_progress(bot, job)
+    job.task = asyncio.create_task(
+        _run_broadcast_job(bot, job, iter_job_recipients(job, segment), payload)
+    )
+    return job
+
+
+async def resume_broadcast_jobs(bot):
+    """Продолжает рассылки, прерванные остановкой бота, с места остановки"""
+    for row in await db.call(get_unfinished_broadcast_jobs):
+        (job_id, title, payload, admin_chat_id, progress_message_id,
+         total, sent, failed, segment, cursor, complete, dedup_key,
+         unreachable, rate_limited, retried) = row
+        segment = json.loads(segment) if segment else None
+        stats = BroadcastStats(total)
+        stats.sent = stats.sent_before = sent
+        stats.failed = failed
+        stats.unreachable = unreachable
+        stats.rate_limited = rate_limited
+        stats.retried = retried
+        try:
+            snapshot = await db.call(
+                AudienceSnapshot.load,
+                broadcast_snapshot_path(job_id),
+                cursor,
+                use_mmap=bool(complete),
+                has_progress=bool(sent or failed),
+            )
+        except OSError as e:
+            logger.error(f"Broadcast {job_id} «{title}» cannot be resumed: {e}")
+            await db.call(save_broadcast_stats, job_id, stats, "failed")
+            try:
+                await bot.send_message(
+                    chat_id=admin_chat_id,
+                    text=f"Рассылку #{job_id} «{title}» не удалось продолжить: "
+                    "потерян снимок аудитории. Запустите ее заново.",
+                )
+            except Exception as notify_error:
+                logger.error(f"Failed to report broadcast {job_id}: {notify_error}")
+            continue
+        job = BroadcastJob(job_id, title, stats, snapshot)
+        job.admin_chat_id = admin_chat_id
+        job.progress_message_id = progress_message_id
+        _broadcast_jobs[job.id] = job
+        if dedup_key:
+            job_future = asyncio.get_running_loop().create_future()
+            job_future.set_result(job)
+            _register_broadcast_dedup(dedup_key, job_future)
+        logger.info(f"Resuming broadcast {job_id} «{title}»: {total - sent - failed} recipients left")
+        recipients = iter_job_recipients(job, segment, bool(complete))
+        job.task = asyncio.create_task(
+            _run_broadcast_job(bot, job, recipients, json.loads(payload))
+        )
+
+
+async def cancel_broadcast(update, context):
+    query = update.callback_query
+    if not is_admin(update.effective_user.id):
+        await query.answer("У вас нет прав администратора.")
+        return
+    job_id = int(query.data.split(":", 1)[1])
+    job = _broadcast_jobs.get(job_id)
+    if not job or job.status != "running":
+        await query.answer("Рассылка уже завершена.")
+        return
+    job.cancel_requested = True
+    job.task.cancel()
+    await query.answer("Рассылка отменяется...")
+
+
+async def broadcasts_menu(update, context):
+    """Показывает администратору текущие и последние рассылки"""
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(update.effective_user.id):
+        await query.edit_message_text("У вас нет доступа к админ-панели.")
+        return
+    jobs = sorted(_broadcast_jobs.values(), key=lambda job: job.id, reverse=True)[:10]
+    scheduled = await db.call(get_pending_scheduled_broadcasts)
+    parts = [format_broadcast_progress(job) for job in jobs]
+    if scheduled:
+        parts.append(
+            "Запланированные рассылки:\n"
+            + "\n".join(
+                f"#{schedule_id} «{title}» — "
+                f"{datetime.strptime(run_at, '%Y-%m-%d %H:%M:%S').strftime(SCHEDULE_TIME_FORMAT)}"
+                for schedule_id, title, run_at in scheduled
+            )
+        )
+    text = "\n\n".join(parts) if parts else "Рассылок пока не было."
+    keyboard = [
+        [InlineKeyboardButton(f"Отменить рассылку #{job.id}", callback_data=f"cancel_broadcast:{job.id}")]
+        for job in jobs
+        if job.status == "running"
+    ]
+    keyboard += [
+        [InlineKeyboardButton(f"Отменить запланированную #{schedule_id}", callback_data=f"cancel_scheduled:{schedule_id}")]
+        for schedule_id, _, _ in scheduled
+    ]
+    keyboard.append([InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")])
+    try:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+
+# Сегменты аудитории рассылок: имя -> подпись кнопки в админ-панели.
+# Сегменты конкурса доступны только для текущего (активного) конкурса.
+AUDIENCE_SEGMENTS = {
+    "all": "Всем пользователям",
+    "verified": "Верифицированным",
+    "participants": "Участникам текущего конкурса",
+    "non_participants": "Не участвующим в текущем конкурсе",
+    "active_7": "Активным за 7 дней",
+    "active_30": "Активным за 30 дней",
+}
+CONTEST_SEGMENTS = ("participants", "non_participants")
+
+
+def audience_spec(name, contest=None):
+    """
+    Сегмент аудитории в том виде, в котором он сохраняется в задании
+    рассылки: имя и, для сегментов конкурса, id конкурса. SQL по нему
+    каждый раз строит audience_segment, в базе запросы не хранятся.
+    """
+    contest_id = contest.id if contest and name in CONTEST_SEGMENTS else None
+    return {"name": name, "contest_id": contest_id}
+
+
+def audience_segment(name, contest_id=None):
+    """
+    Фильтр аудитории по имени сегмента: условие поверх users и его
+    параметры, None — без фильтра. Для сегментов конкурса нужен contest_id.
+    """
+    if name == "all":
+        return None
+    if name == "verified":
+        return ("user_id IN (SELECT user_id FROM verified_users)", ())
+    if name == "participants":
+        return ("user_id IN (SELECT user_id FROM participants WHERE contest_id = ?)", (contest_id,))
+    if name == "non_participants":
+        return ("user_id NOT IN (SELECT user_id FROM participants WHERE contest_id = ?)", (contest_id,))
+    if name.startswith("active_"):
+        days = int(name.split("_", 1)[1])
+        return ("last_seen_at >= datetime('now', ?)", (f"-{days} days",))
+    raise ValueError(f"Unknown audience segment: {name}")
+
+
+async def audience_choice_markup(callback_prefix, back_callback):
+    """Кнопки выбора сегмента с текущим размером каждого"""
+    contest = get_active_contest()
+    await _new_users.flush()
+    await _blocked_changes.flush()
+    await _seen_users.flush()
+    keyboard = []
+    for name, label in AUDIENCE_SEGMENTS.items():
+        if name in CONTEST_SEGMENTS and not contest:
+            continue
+        count = await db.call(count_audience, audience_spec(name, contest))
+        keyboard.append(
+            [InlineKeyboardButton(f"{label} ({count})", callback_data=f"{callback_prefix}:{name}")]
+        )
+    keyboard.append([InlineKeyboardButton("Назад", callback_data=back_callback)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def notify_all_users(contest, context, admin_chat_id, segment_name="all"):
+    """
+    Запускает фоновую рассылку уведомления о конкурсе пользователям
+    сегмента segment_name (по умолчанию всем). Возвращает задание рассылки
+    или None, если рассылать некому.
+    """
+    return await start_broadcast_job(
+        context.bot,
+        admin_chat_id,
+        f"конкурс {contest.title} → {AUDIENCE_SEGMENTS[segment_name]}",
+        contest_broadcast_payload(contest),
+        audience_spec(segment_name, contest),
+    )
+
+
 async def notify_contest(update: Update, context: CallbackContext):
     """
-    Отправляет уведомление о текущем конкурсе всем пользователям и подтверждает администратору.
+    Предлагает выбрать аудиторию уведомления о текущем конкурсе.
     """
     query = update.callback_query
     await query.answer()
@@ -1093,36 +2727,447 @@ async def notify_contest(update: Update, context: CallbackContext):
             text="Нет активного конкурса для уведомления."
         )
         return
-    
-    await notify_all_users(contest, context)
-    
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="Уведомление о конкурсе успешно отправлено всем пользователям!"
+
+    await query.edit_message_text(
+        "Кому отправить уведомление о конкурсе?",
+        reply_markup=await audience_choice_markup("notify_contest_to", "contest"),
     )
 
-async def notify_all_users_with_post(post_photo, post_title, post_text, context):
+
+async def notify_contest_to(update: Update, context: CallbackContext):
     """
-    Отправляет пост всем пользователям из базы данных.
+    Запускает уведомление о текущем конкурсе выбранному сегменту и сразу
+    возвращает администратору сообщение с прогрессом рассылки.
     """
-    users = get_all_users()
-    if not users:
-        logger.warning("Список пользователей пуст.")
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(update.effective_user.id):
         return
-    
-    preview = format_post_preview(post_title, post_text)
-    
-    for user_id in users:
+
+    contest = get_active_contest()
+    if not contest:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Нет активного конкурса для уведомления."
+        )
+        return
+
+    segment_name = query.data.split(":", 1)[1]
+    job = await notify_all_users(contest, context, update.effective_chat.id, segment_name)
+    if not job:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="В выбранной аудитории никого нет, уведомлять некого."
+        )
+
+
+async def notify_all_users_with_post(
+    post_photo, post_title, post_text, context, admin_chat_id, segment_name="all"
+):
+    """
+    Запускает фоновую рассылку поста пользователям сегмента segment_name
+    (по умолчанию всем). Возвращает задание рассылки или None, если
+    рассылать некому.
+    """
+    contest = get_active_contest()
+    payload = post_broadcast_payload(post_photo, post_title, post_text)
+    return await start_broadcast_job(
+        context.bot,
+        admin_chat_id,
+        f"пост {post_title} → {AUDIENCE_SEGMENTS[segment_name]}",
+        payload,
+        audience_spec(segment_name, contest),
+    )
+
+
+def contest_broadcast_payload(contest):
+    return {
+        "photo": contest.photo_id,
+        "caption": format_contest_notification(contest.title, contest.end_date),
+        "participate_button": True,
+    }
+
+
+def post_broadcast_payload(post_photo, post_title, post_text):
+    return {
+        "photo": post_photo,
+        "caption": format_post_preview(post_title, post_text),
+    }
+
+
+def parse_schedule_time(text):
+    """Разбирает «ДД.ММ.ГГГГ ЧЧ:ММ»; None, если формат неверный"""
+    try:
+        return datetime.strptime(text.strip(), SCHEDULE_TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def schedule_broadcast(
+    kind, title, admin_chat_id, run_at, payload=None, contest_id=None, segment_name="all"
+):
+    """
+    Сохраняет запланированную рассылку. Для kind="contest" содержимое
+    собирается в момент отправки из конкурса contest_id, для kind="post"
+    берется из payload. segment_name — имя сегмента из AUDIENCE_SEGMENTS;
+    сегменты конкурса в момент отправки относятся к активному конкурсу.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO scheduled_broadcasts "
+            "(kind, title, payload, contest_id, admin_chat_id, run_at, segment) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                kind,
+                title,
+                json.dumps(payload) if payload else None,
+                contest_id,
+                admin_chat_id,
+                run_at.strftime("%Y-%m-%d %H:%M:%S"),
+                segment_name,
+            ),
+        )
+        return c.lastrowid
+
+
+def get_next_schedule_time():
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT MIN(run_at) FROM scheduled_broadcasts WHERE status = 'pending'")
+        run_at = c.fetchone()[0]
+    return datetime.strptime(run_at, "%Y-%m-%d %H:%M:%S") if run_at else None
+
+
+def get_due_scheduled_broadcasts(now):
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id, kind, title, payload, contest_id, admin_chat_id, segment "
+            "FROM scheduled_broadcasts "
+            "WHERE status = 'pending' AND run_at <= ? ORDER BY run_at",
+            (now.strftime("%Y-%m-%d %H:%M:%S"),),
+        )
+        return c.fetchall()
+
+
+def get_pending_scheduled_broadcasts():
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id, title, run_at FROM scheduled_broadcasts "
+            "WHERE status = 'pending' ORDER BY run_at"
+        )
+        return c.fetchall()
+
+
+def set_scheduled_broadcast_status(schedule_id, status, job_id=None, only_pending=False):
+    """Меняет статус запланированной рассылки; возвращает True, если строка обновлена"""
+    sql = "UPDATE scheduled_broadcasts SET status = ?, job_id = ? WHERE id = ?"
+    if only_pending:
+        sql += " AND status = 'pending'"
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(sql, (status, job_id, schedule_id))
+        return c.rowcount == 1
+
+
+async def _skip_scheduled_broadcast(bot, schedule_id, admin_chat_id, text):
+    await db.call(set_scheduled_broadcast_status, schedule_id, "skipped")
+    try:
+        await bot.send_message(chat_id=admin_chat_id, text=text)
+    except Exception as e:
+        logger.error(f"Failed to report scheduled broadcast {schedule_id}: {e}")
+
+
+async def run_scheduled_broadcast(bot, row):
+    schedule_id, kind, title, payload, contest_id, admin_chat_id, segment_name = row
+    segment_name = segment_name or "all"
+    contest = get_active_contest()
+    if kind == "contest":
+        if not contest or contest.id != contest_id:
+            logger.warning(f"Scheduled broadcast {schedule_id}: contest {contest_id} is no longer active")
+            await _skip_scheduled_broadcast(
+                bot, schedule_id, admin_chat_id,
+                f"Запланированное уведомление «{title}» не отправлено: конкурс уже не активен.",
+            )
+            return
+        payload = contest_broadcast_payload(contest)
+    else:
+        payload = json.loads(payload)
+    if segment_name in CONTEST_SEGMENTS and not contest:
+        logger.warning(f"Scheduled broadcast {schedule_id}: no active contest for segment {segment_name}")
+        await _skip_scheduled_broadcast(
+            bot, schedule_id, admin_chat_id,
+            f"Запланированная рассылка «{title}» не отправлена: нет активного конкурса.",
+        )
+        return
+    # Статус меняется после запуска: если бот упадет между этими шагами,
+    # повторный запуск присоединится к заданию через ключ дедупликации.
+    try:
+        job = await start_broadcast_job(
+            bot, admin_chat_id, title, payload, audience_spec(segment_name, contest)
+        )
+    except Exception as e:
+        # Не запускаем повторно на каждом пробуждении планировщика:
+        # администратор увидит ошибку и запланирует рассылку заново.
+        logger.error(f"Scheduled broadcast {schedule_id} failed to start: {e}")
+        await db.call(set_scheduled_broadcast_status, schedule_id, "failed")
         try:
-            await context.bot.send_photo(
-                chat_id=user_id,
-                photo=post_photo,
-                caption=preview,
-                parse_mode='HTML'
+            await bot.send_message(
+                chat_id=admin_chat_id,
+                text=f"Запланированная рассылка «{title}» не запущена из-за ошибки: {e}",
             )
-            logger.info(f"Post sent to user {user_id}")
+        except Exception as notify_error:
+            logger.error(f"Failed to report scheduled broadcast {schedule_id}: {notify_error}")
+        return
+    if not job:
+        await _skip_scheduled_broadcast(
+            bot, schedule_id, admin_chat_id,
+            f"Запланированная рассылка «{title}» не отправлена: в выбранной аудитории никого нет.",
+        )
+        return
+    await db.call(set_scheduled_broadcast_status, schedule_id, "started", job.id)
+
+
+async def run_scheduler(bot):
+    """
+    Запускает запланированные рассылки в срок. Расписание хранится в
+    scheduled_broadcasts, поэтому после перезапуска планировщик просто
+    продолжает с него, а пропущенные за время простоя рассылки уходят сразу.
+    """
+    while True:
+        try:
+            next_run = await db.call(get_next_schedule_time)
+            delay = SCHEDULER_MAX_SLEEP
+            if next_run is not None:
+                delay = min(delay, (next_run - datetime.now()).total_seconds())
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(_scheduler_wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                _scheduler_wakeup.clear()
+                continue
+            for row in await db.call(get_due_scheduled_broadcasts, datetime.now()):
+                await run_scheduled_broadcast(bot, row)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Ошибка при отправке поста пользователю {user_id}: {e}")
+            logger.error(f"Scheduler error: {e}")
+            await asyncio.sleep(SCHEDULER_MAX_SLEEP)
+
+
+_scheduler_wakeup = asyncio.Event()
+
+
+async def cancel_scheduled(update, context):
+    query = update.callback_query
+    if not is_admin(update.effective_user.id):
+        await query.answer("У вас нет прав администратора.")
+        return
+    schedule_id = int(query.data.split(":", 1)[1])
+    if await db.call(set_scheduled_broadcast_status, schedule_id, "cancelled", None, True):
+        await query.answer("Запланированная рассылка отменена.")
+    else:
+        await query.answer("Рассылка уже запущена или отменена.")
+    await broadcasts_menu(update, context)
+
+
+async def start_schedule_contest(update, context):
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(update.effective_user.id):
+        await query.edit_message_text("У вас нет доступа к админ-панели.")
+        return ConversationHandler.END
+    if not get_active_contest():
+        await query.edit_message_text("Нет активного конкурса для уведомления.")
+        return ConversationHandler.END
+    await query.edit_message_text(
+        "Введите дату и время отправки уведомления (ДД.ММ.ГГГГ ЧЧ:ММ)."
+    )
+    return SCHEDULE_CONTEST_TIME
+
+
+async def schedule_contest_time(update, context):
+    run_at = parse_schedule_time(update.message.text)
+    if not run_at or run_at <= datetime.now():
+        await update.message.reply_text(
+            "Некорректное время. Введите будущую дату и время в формате ДД.ММ.ГГГГ ЧЧ:ММ."
+        )
+        return SCHEDULE_CONTEST_TIME
+    if not get_active_contest():
+        await update.message.reply_text("Нет активного конкурса для уведомления.")
+        return ConversationHandler.END
+    context.user_data["schedule_run_at"] = run_at
+    await update.message.reply_text(
+        "Кому отправить уведомление о конкурсе?",
+        reply_markup=await audience_choice_markup("schedule_contest_to", "back_to_admin_panel"),
+    )
+    return SCHEDULE_CONTEST_AUDIENCE
+
+
+async def schedule_contest_audience(update, context):
+    query = update.callback_query
+    await query.answer()
+    contest = get_active_contest()
+    if not contest:
+        await query.edit_message_text("Нет активного конкурса для уведомления.")
+        return ConversationHandler.END
+    segment_name = query.data.split(":", 1)[1]
+    run_at = context.user_data.pop("schedule_run_at")
+    await db.call(
+        schedule_broadcast,
+        "contest",
+        f"конкурс {contest.title} → {AUDIENCE_SEGMENTS[segment_name]}",
+        update.effective_chat.id,
+        run_at,
+        contest_id=contest.id,
+        segment_name=segment_name,
+    )
+    _scheduler_wakeup.set()
+    await query.edit_message_text(
+        f"Уведомление о конкурсе запланировано на {run_at.strftime(SCHEDULE_TIME_FORMAT)}.",
+        reply_markup=InlineKeyboardMarkup(admin_panel_keyboard()),
+    )
+    return ConversationHandler.END
+
+
+async def schedule_post_prompt(update, context):
+    query = update.callback_query
+    await query.answer()
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="Введите дату и время публикации поста (ДД.ММ.ГГГГ ЧЧ:ММ).",
+    )
+    return SCHEDULE_POST_TIME
+
+
+async def schedule_post_time(update, context):
+    run_at = parse_schedule_time(update.message.text)
+    if not run_at or run_at <= datetime.now():
+        await update.message.reply_text(
+            "Некорректное время. Введите будущую дату и время в формате ДД.ММ.ГГГГ ЧЧ:ММ."
+        )
+        return SCHEDULE_POST_TIME
+    context.user_data["schedule_run_at"] = run_at
+    await update.message.reply_text(
+        "Кому отправить пост?",
+        reply_markup=await audience_choice_markup("schedule_post_to", "back_to_admin_panel"),
+    )
+    return SCHEDULE_POST_AUDIENCE
+
+
+async def schedule_post_audience(update, context):
+    query = update.callback_query
+    await query.answer()
+    segment_name = query.data.split(":", 1)[1]
+    run_at = context.user_data.pop("schedule_run_at")
+    post_photo = context.user_data["post_photo"]
+    post_title = context.user_data["post_title"]
+    post_text = context.user_data["post_text"]
+    await db.call(create_post, post_photo, post_title, post_text)
+    await db.call(
+        schedule_broadcast,
+        "post",
+        f"пост {post_title} → {AUDIENCE_SEGMENTS[segment_name]}",
+        update.effective_chat.id,
+        run_at,
+        payload=post_broadcast_payload(post_photo, post_title, post_text),
+        segment_name=segment_name,
+    )
+    _scheduler_wakeup.set()
+    await query.edit_message_text(
+        f"Пост запланирован на {run_at.strftime(SCHEDULE_TIME_FORMAT)}.",
+        reply_markup=InlineKeyboardMarkup(admin_panel_keyboard()),
+    )
+    return ConversationHandler.END
+
+
+async def leave_schedule(update, context):
+    """Кнопка «Назад» при выборе аудитории: панель покажет back_to_admin_panel"""
+    context.user_data.pop("schedule_run_at", None)
+    return ConversationHandler.END
+
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+class SubscriptionCache:
+    """
+    Статусы подписки на канал по user_id со сроком жизни: positive_ttl
+    секунд для подписанных и negative_ttl для остальных. Счетчики для
+    админ-панели: hits — ответы из кэша, local_hits — из таблицы
+    channel_members, api_calls — запросы getChatMember, когда свежей
+    записи о подписке в ней нет.
+    """
+
+    def __init__(self, positive_ttl, negative_ttl, max_size):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # user_id -> (статус, момент устаревания по time.monotonic())
+        self._entries = {}
+        self.hits = 0
+        self.local_hits = 0
+        self.api_calls = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        return None
+
+    def set(self, user_id, status):
+        now = time.monotonic()
+        self._entries.pop(user_id, None)
+        if len(self._entries) >= self.max_size:
+            for key, (_, expires_at) in list(self._entries.items()):
+                if expires_at <= now:
+                    del self._entries[key]
+            if len(self._entries) >= self.max_size:
+                # Записи идут в порядке добавления: вытесняем самую старую.
+                del self._entries[next(iter(self._entries))]
+        ttl = self.positive_ttl if status in SUBSCRIBED_STATUSES else self.negative_ttl
+        self._entries[user_id] = (status, now + ttl)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+
+_subscriptions = SubscriptionCache(
+    SUBSCRIPTION_TTL, SUBSCRIPTION_NEGATIVE_TTL, SUBSCRIPTION_CACHE_LIMIT
+)
+
+
+async def get_subscription_status(bot, user_id):
+    """
+    Статус пользователя в канале SUBSCRIPTION_CHANNEL: из кэша, из таблицы
+    channel_members (только свежая подписка, см. get_channel_member_status)
+    или через getChatMember с записью ответа в таблицу. Апдейты одного
+    пользователя идут по очереди (см. PerUserUpdateProcessor), поэтому
+    одновременных запросов по одному пользователю не бывает: повторное
+    обращение получает ответ первого из кэша, если вызывающий не сбросил
+    запись (см. check_subscription). Ошибки Bot API не кэшируются.
+    """
+    status = _subscriptions.get(user_id)
+    if status is not None:
+        return status
+    status = await db.call(get_channel_member_status, user_id)
+    if status is None:
+        _subscriptions.api_calls += 1
+        chat_member = await bot.get_chat_member(chat_id=SUBSCRIPTION_CHANNEL, user_id=user_id)
+        status = chat_member.status
+        _channel_member_changes.add((user_id, status))
+    else:
+        _subscriptions.local_hits += 1
+    _subscriptions.set(user_id, status)
+    return status
+
 
 async def participate(update, context):
     query = update.callback_query
@@ -1130,7 +3175,6 @@ async def participate(update, context):
     
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    channel_id = "@BAZUMI_discountt"
     
     logger.info(f"participate called for user {user_id} from chat {chat_id}")
     
@@ -1144,10 +3188,10 @@ async def participate(update, context):
         )
         return ConversationHandler.END
     
-    contest_id = contest[0]
+    contest_id = contest.id
     context.user_data["contest_id"] = contest_id
     
-    if is_participant(contest_id, user_id):
+    if await db.call(is_participant, contest_id, user_id):
         text = "Вы уже зарегистрированы в этом конкурсе!"
         is_channel_or_group = update.effective_chat.type in ['channel', 'group', 'supergroup']
         target_chat_id = user_id if is_channel_or_group else chat_id
@@ -1163,8 +3207,7 @@ async def participate(update, context):
         return ConversationHandler.END
     
     try:
-        chat_member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-        status = chat_member.status
+        status = await get_subscription_status(context.bot, user_id)
     except Exception as e:
         logger.error(f"Error checking subscription for user {user_id}: {e}")
         is_channel_or_group = update.effective_chat.type in ['channel', 'group', 'supergroup']
@@ -1175,19 +3218,14 @@ async def participate(update, context):
         )
         return ConversationHandler.END
     
-    if status in ["member", "administrator", "creator"]:
+    if status in SUBSCRIBED_STATUSES:
         is_channel_or_group = update.effective_chat.type in ['channel', 'group', 'supergroup']
         target_chat_id = user_id if is_channel_or_group else chat_id
         
         if is_user_verified(user_id):
-            conn = sqlite3.connect("bazumi_bot.db")
-            c = conn.cursor()
-            c.execute("SELECT phone_number FROM verified_users WHERE user_id = ?", (user_id,))
-            result = c.fetchone()
-            conn.close()
-            if result and result[0]:
-                phone_number = result[0]
-                add_participant(contest_id, user_id, update.effective_user.username, phone_number)
+            phone_number = await db.call(get_verified_phone, user_id)
+            if phone_number:
+                await db.call(add_participant, contest_id, user_id, update.effective_user.username, phone_number)
                 text = "Отлично, вы зарегистрированы как участник. Желаем вам удачи и остаемся на связи! Ваш Bazumi ♥️"
                 keyboard = [
                     [InlineKeyboardButton("Назад", callback_data="go_back")],
@@ -1243,31 +3281,24 @@ async def check_subscription(update, context):
     await query.answer()
 
     user_id = update.effective_user.id
-    channel_id = "@BAZUMI_discountt"
-
-    if context.user_data.get("checking_subscription"):
-        logger.info(f"User {user_id} already checking subscription, skipping")
-        return ConversationHandler.END
-    context.user_data["checking_subscription"] = True
+    # «Проверить подписку» нажимают сразу после подписки: отказ из кэша
+    # устарел. Подписка без запроса найдется в таблице channel_members.
+    _subscriptions.invalidate(user_id)
 
     try:
-        chat_member = await context.bot.get_chat_member(
-            chat_id=channel_id, user_id=user_id
-        )
-        status = chat_member.status
+        status = await get_subscription_status(context.bot, user_id)
         logger.info(f"User {user_id} subscription status: {status}")
 
-        if status in ["member", "administrator", "creator"]:
+        if status in SUBSCRIBED_STATUSES:
             contest = get_active_contest()
             if not contest:
                 await query.edit_message_text(
                     text="К сожалению, в данный момент нет активных конкурсов.",
                     reply_markup=None  # Удаляем клавиатуру
                 )
-                context.user_data["checking_subscription"] = False
                 return ConversationHandler.END
 
-            context.user_data["contest_id"] = contest[0]
+            context.user_data["contest_id"] = contest.id
             await query.message.reply_text(
                 text="Отлично, вы подписаны! Подтвердите, что вы не бот.",
                 reply_markup=ReplyKeyboardMarkup(
@@ -1278,7 +3309,6 @@ async def check_subscription(update, context):
             )
             await query.message.delete()
             logger.info(f"User {user_id} subscribed, requesting contact")
-            context.user_data["checking_subscription"] = False
             return PARTICIPATE_CONFIRM
 
         else:
@@ -1301,7 +3331,6 @@ async def check_subscription(update, context):
 
             if current_text == new_text:
                 logger.info(f"User {user_id} not subscribed, message unchanged, skipping edit")
-                context.user_data["checking_subscription"] = False
                 return ConversationHandler.END
 
             await query.edit_message_text(
@@ -1309,16 +3338,14 @@ async def check_subscription(update, context):
                 reply_markup=new_reply_markup
             )
             logger.info(f"User {user_id} not subscribed, prompting again")
-            context.user_data["checking_subscription"] = False
             return ConversationHandler.END
 
-    except telegram.error.BadRequest as e:
+    except BadRequest as e:
         logger.error(f"BadRequest error for user {user_id}: {e}")
         await query.edit_message_text(
             text="Ошибка при проверке подписки. Попробуйте снова позже.",
             reply_markup=None
         )
-        context.user_data["checking_subscription"] = False
         return ConversationHandler.END
     except Exception as e:
         logger.error(f"Unexpected error re-checking subscription for user {user_id}: {e}", exc_info=True)
@@ -1326,7 +3353,6 @@ async def check_subscription(update, context):
             text="Ошибка при проверке подписки. Попробуйте снова позже.",
             reply_markup=None
         )
-        context.user_data["checking_subscription"] = False
         return ConversationHandler.END
 
 
@@ -1336,15 +3362,13 @@ async def check_subscription_gifts(update, context):
 
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    channel_id = "@BAZUMI_discountt"
+    # Как в check_subscription: повторная проверка не верит кэшу.
+    _subscriptions.invalidate(user_id)
 
     try:
-        chat_member = await context.bot.get_chat_member(
-            chat_id=channel_id, user_id=user_id
-        )
-        status = chat_member.status
+        status = await get_subscription_status(context.bot, user_id)
 
-        if status in ["member", "administrator", "creator"]:
+        if status in SUBSCRIBED_STATUSES:
             contest = get_active_contest()
             if not contest:
                 await query.edit_message_text(
@@ -1352,10 +3376,10 @@ async def check_subscription_gifts(update, context):
                 )
                 return
 
-            contest_id = contest[0]
+            contest_id = contest.id
             context.user_data["contest_id"] = contest_id
 
-            if is_participant(contest_id, user_id):
+            if await db.call(is_participant, contest_id, user_id):
                 text = "Вы уже зарегистрированы в этом конкурсе!"
                 keyboard = [
                     [InlineKeyboardButton("Назад", callback_data="go_back")],
@@ -1375,18 +3399,11 @@ async def check_subscription_gifts(update, context):
                 return
 
             if is_user_verified(user_id):
-                conn = sqlite3.connect("bazumi_bot.db")
-                c = conn.cursor()
-                c.execute(
-                    "SELECT phone_number FROM verified_users WHERE user_id = ?",
-                    (user_id,),
-                )
-                result = c.fetchone()
-                conn.close()
+                phone_number = await db.call(get_verified_phone, user_id)
 
-                if result and result[0]:
-                    phone_number = result[0]
-                    add_participant(
+                if phone_number:
+                    await db.call(
+                        add_participant,
                         contest_id,
                         user_id,
                         update.effective_user.username,
@@ -1456,7 +3473,6 @@ async def confirm_participate(update, context):
     logger.info(f"confirm_participate called for user {update.effective_user.id}")
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    channel_id = "@BAZUMI_discountt"
 
     try:
         contest = get_active_contest()
@@ -1467,11 +3483,11 @@ async def confirm_participate(update, context):
             )
             return
 
-        contest_id = contest[0]
+        contest_id = contest.id
         context.user_data["contest_id"] = contest_id
         logger.info(f"Setting contest_id={contest_id} in user_data for user {user_id}")
 
-        if is_participant(contest_id, user_id):
+        if await db.call(is_participant, contest_id, user_id):
             text = "Вы уже зарегистрированы в этом конкурсе!"
             keyboard = [
                 [InlineKeyboardButton("Назад", callback_data="go_back")],
@@ -1487,12 +3503,38 @@ async def confirm_participate(update, context):
             )
             return
 
-        chat_member = await context.bot.get_chat_member(
-            chat_id=channel_id, user_id=user_id
-        )
-        status = chat_member.status
+        status = await get_subscription_status(context.bot, user_id)
+
+        if status in SUBSCRIBED_STATUSES:
+            phone_number = None
+            if is_user_verified(user_id):
+                phone_number = await db.call(get_verified_phone, user_id)
+            if phone_number:
+                added = await db.call(
+                    register_participant,
+                    contest_id,
+                    user_id,
+                    update.effective_user.username,
+                    phone_number,
+                )
+                if added:
+                    text = "Отлично, вы зарегистрированы как участник. Желаем вам удачи и остаемся на связи! Ваш Bazumi ♥️"
+                else:
+                    text = "Вы уже зарегистрированы в этом конкурсе!"
+                keyboard = [
+                    [InlineKeyboardButton("Назад", callback_data="go_back")],
+                    [
+                        InlineKeyboardButton(
+                            "В главное меню", callback_data="go_to_main_menu"
+                        )
+                    ],
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                await context.bot.send_message(
+                    chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode="HTML"
+                )
+                return
 
-        if status in ["member", "administrator", "creator"]:
             context.user_data["conversation_state"] = PARTICIPATE_CONFIRM
             logger.info(f"Setting conversation_state to PARTICIPATE_CONFIRM for user {user_id}")
             
@@ -1535,6 +3577,7 @@ async def confirm_participate(update, context):
         )
         return
 
+
 async def export_participants(update, context):
     query = update.callback_query
     await query.answer()
@@ -1550,11 +3593,11 @@ async def export_participants(update, context):
         await show_contest_menu(update, context)
         return
 
-    logger.info(f"Exporting participants for contest ID: {contest[0]}")
-    participants = get_participants(contest[0])
+    logger.info(f"Exporting participants for contest ID: {contest.id}")
+    participants = await db.call(get_participants, contest.id)
 
     if not participants:
-        logger.info(f"No participants found for contest ID: {contest[0]}")
+        logger.info(f"No participants found for contest ID: {contest.id}")
         await context.bot.send_message(
             chat_id=update.effective_chat.id, text="Нет участников для выгрузки."
         )
@@ -1563,12 +3606,14 @@ async def export_participants(update, context):
         return
 
     participants_text = (
-        f"Список участников конкурса '{contest[2]}' (ID: {contest[0]}):\n\n"
+        f"Список участников конкурса '{contest.title}' (ID: {contest.id}):\n\n"
     )
     for p in participants:
         username = p[0] if p[0] else "Без имени"  # p[0] - username
         phone_number = p[1]  # p[1] - phone_number
-        participants_text += f"@{username} - {phone_number}\n"
+        # p[2] - результат последней проверки подписки: 0 — отписался
+        mark = " — не подписан" if p[2] == 0 else ""
+        participants_text += f"@{username} - {phone_number}{mark}\n"
 
     logger.info(f"Participants exported: {len(participants)} entries")
 
@@ -1580,6 +3625,243 @@ async def export_participants(update, context):
     await show_contest_menu(update, context)
 
 
+def create_subscription_check(contest_id, admin_chat_id, progress_message_id):
+    """Сохраняет задание перепроверки и возвращает (id, время запуска)"""
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            """INSERT INTO subscription_checks (contest_id, admin_chat_id, progress_message_id)
+               VALUES (?, ?, ?)""",
+            (contest_id, admin_chat_id, progress_message_id),
+        )
+        check_id = c.lastrowid
+        c.execute("SELECT started_at FROM subscription_checks WHERE id = ?", (check_id,))
+        return check_id, c.fetchone()[0]
+
+
+def finish_subscription_check(check_id, status):
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE subscription_checks SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, check_id),
+        )
+
+
+def get_running_subscription_checks():
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id, contest_id, admin_chat_id, progress_message_id, started_at "
+            "FROM subscription_checks WHERE status = 'running' ORDER BY id"
+        )
+        return c.fetchall()
+
+
+def get_unchecked_participants(contest_id, since, after_user_id, limit=AUDIENCE_PAGE_SIZE):
+    """Страница участников, не проверенных с момента since, по возрастанию user_id"""
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT user_id FROM participants WHERE contest_id = ? AND user_id > ? "
+            "AND (checked_at IS NULL OR checked_at < ?) ORDER BY user_id LIMIT ?",
+            (contest_id, after_user_id, since, limit),
+        )
+        return [row[0] for row in c.fetchall()]
+
+
+def count_participant_checks(contest_id, since):
+    """(всего участников, проверено, не подписаны, не удалось проверить) с момента since"""
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT COUNT(*), "
+            "COALESCE(SUM(checked_at >= ?), 0), "
+            "COALESCE(SUM(checked_at >= ? AND subscribed = 0), 0), "
+            "COALESCE(SUM(checked_at >= ? AND subscribed IS NULL), 0) "
+            "FROM participants WHERE contest_id = ?",
+            (since, since, since, contest_id),
+        )
+        return c.fetchone()
+
+
+def save_participant_checks(results):
+    """
+    Записывает пачку результатов [(contest_id, user_id, subscribed)] одной
+    транзакцией; subscribed=None — проверить не удалось.
+    """
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "UPDATE participants SET subscribed = ?, checked_at = CURRENT_TIMESTAMP "
+            "WHERE contest_id = ? AND user_id = ?",
+            ((subscribed, contest_id, user_id) for contest_id, user_id, subscribed in results),
+        )
+
+
+_participant_checks = WriteBehindBuffer(
+    save_participant_checks, BROADCAST_CHECKPOINT_INTERVAL, BROADCAST_CHECKPOINT_BATCH
+)
+# contest_id -> задача идущей перепроверки подписок.
+_subscription_check_tasks = {}
+
+
+async def iter_unchecked_participants(contest_id, since):
+    after = 0
+    while True:
+        page = await db.call(get_unchecked_participants, contest_id, since, after)
+        if not page:
+            return
+        for user_id in page:
+            yield user_id
+        after = page[-1]
+
+
+async def format_subscription_check(contest_id, since, status, stats):
+    await _participant_checks.flush()
+    total, checked, unsubscribed, errors = await db.call(
+        count_participant_checks, contest_id, since
+    )
+    return (
+        f"Проверка подписок участников: {BROADCAST_STATUS_TEXT[status]}\n"
+        f"Проверено: {checked} из {total}\n"
+        f"Не подписаны: {unsubscribed}\n"
+        f"Не удалось проверить: {errors}\n"
+        f"Скорость: {stats.rate:.1f} проверок/с"
+    )
+
+
+async def _report_subscription_check(bot, admin_chat_id, message_id, contest_id, since, status, stats):
+    try:
+        await bot.edit_message_text(
+            chat_id=admin_chat_id,
+            message_id=message_id,
+            text=await format_subscription_check(contest_id, since, status, stats),
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            logger.warning(f"Failed to update subscription check progress: {e}")
+    except Exception as e:
+        logger.warning(f"Failed to update subscription check progress: {e}")
+
+
+async def _run_subscription_check(bot, check_id, contest_id, since, admin_chat_id, message_id):
+    """
+    Перепроверяет подписку всех участников конкурса через getChatMember
+    движком рассылок: с ограничением параллельности и темпа и паузой по
+    RetryAfter. Результаты пишутся в participants пачками; после
+    перезапуска бота проверка продолжается с непроверенных участников.
+    """
+    stats = BroadcastStats()
+
+    async def check(user_id):
+        chat_member = await bot.get_chat_member(chat_id=SUBSCRIPTION_CHANNEL, user_id=user_id)
+        status = chat_member.status
+        _participant_checks.add((contest_id, user_id, status in SUBSCRIBED_STATUSES))
+        _channel_member_changes.add((user_id, status))
+        _subscriptions.set(user_id, status)
+
+    def record(user_id, outcome):
+        if outcome != SEND_OK:
+            _participant_checks.add((contest_id, user_id, None))
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await _report_subscription_check(
+                bot, admin_chat_id, message_id, contest_id, since, "running", stats
+            )
+
+    reporter = asyncio.create_task(report())
+    status = "failed"
+    try:
+        await broadcast(
+            iter_unchecked_participants(contest_id, since),
+            check,
+            rate=SUBSCRIPTION_CHECK_RATE,
+            concurrency=SUBSCRIPTION_CHECK_CONCURRENCY,
+            stats=stats,
+            on_result=record,
+        )
+        status = "done"
+    except asyncio.CancelledError:
+        # Остановка бота: проверка остается running и продолжится при запуске.
+        logger.info(f"Subscription check {check_id} interrupted by shutdown: {stats.summary()}")
+        raise
+    except Exception as e:
+        logger.error(f"Subscription check {check_id} failed: {e}")
+    finally:
+        reporter.cancel()
+        _subscription_check_tasks.pop(contest_id, None)
+        await _participant_checks.flush()
+    await db.call(finish_subscription_check, check_id, status)
+    logger.info(f"Subscription check {check_id} for contest {contest_id} {status}: {stats.summary()}")
+    await _report_subscription_check(
+        bot, admin_chat_id, message_id, contest_id, since, status, stats
+    )
+
+
+def _forget_background_task(task):
+    # post_stop мог уже очистить список
+    if task in _background_tasks:
+        _background_tasks.remove(task)
+
+
+def _start_subscription_check(bot, check_id, contest_id, since, admin_chat_id, message_id):
+    task = asyncio.create_task(
+        _run_subscription_check(bot, check_id, contest_id, since, admin_chat_id, message_id)
+    )
+    _subscription_check_tasks[contest_id] = task
+    _background_tasks.append(task)
+    task.add_done_callback(_forget_background_task)
+    return task
+
+
+async def resume_subscription_checks(bot):
+    """Продолжает перепроверки подписок, прерванные остановкой бота"""
+    for check_id, contest_id, admin_chat_id, message_id, since in await db.call(
+        get_running_subscription_checks
+    ):
+        logger.info(f"Resuming subscription check {check_id} for contest {contest_id}")
+        _start_subscription_check(bot, check_id, contest_id, since, admin_chat_id, message_id)
+
+
+async def recheck_participants(update, context):
+    """
+    Запускает в фоне перепроверку подписки всех участников текущего
+    конкурса перед выбором победителя.
+    """
+    query = update.callback_query
+    if not is_admin(update.effective_user.id):
+        await query.answer("У вас нет прав администратора.")
+        return
+    contest = get_active_contest()
+    if not contest:
+        await query.answer("Нет активного конкурса.")
+        return
+    if contest.id in _subscription_check_tasks:
+        await query.answer("Проверка уже идет.")
+        return
+    # Занимаем конкурс до первого await, чтобы повторное нажатие кнопки
+    # не запустило вторую проверку.
+    _subscription_check_tasks[contest.id] = None
+    try:
+        await query.answer()
+        message = await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Проверка подписок участников: запускается",
+        )
+        check_id, since = await db.call(
+            create_subscription_check, contest.id, update.effective_chat.id, message.message_id
+        )
+    except Exception:
+        _subscription_check_tasks.pop(contest.id, None)
+        raise
+    _start_subscription_check(
+        context.bot, check_id, contest.id, since, update.effective_chat.id, message.message_id
+    )
+
+
 async def start_create_post(update, context):
     """Начало создания поста"""
     logger.info(f"Starting create post for user {update.effective_user.id}")
@@ -1697,6 +3979,7 @@ async def create_post_text(update, context):
 
         keyboard = [
             [InlineKeyboardButton("Опубликовать пост", callback_data="publish_post")],
+            [InlineKeyboardButton("Запланировать пост", callback_data="schedule_post")],
             [
                 InlineKeyboardButton(
                     "Редактировать пост", callback_data="edit_post_preview"
@@ -1730,8 +4013,17 @@ async def create_post_preview(update, context):
     await query.answer()
 
     if query.data == "publish_post":
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Кому отправить пост?",
+            reply_markup=await audience_choice_markup("publish_post_to", "edit_post_preview"),
+        )
+        return CREATE_POST_PREVIEW
+    elif query.data.startswith("publish_post_to:"):
+        segment_name = query.data.split(":", 1)[1]
         try:
-            post_id = create_post(
+            post_id = await db.call(
+                create_post,
                 context.user_data["post_photo"],
                 context.user_data["post_title"],
                 context.user_data["post_text"],
@@ -1740,23 +4032,22 @@ async def create_post_preview(update, context):
                 context.user_data["post_title"], context.user_data["post_text"]
             )
 
-            await notify_all_users_with_post(
+            job = await notify_all_users_with_post(
                 context.user_data["post_photo"],
                 context.user_data["post_title"],
                 context.user_data["post_text"],
-                context
-            )
-
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Пост успешно отправлен всем пользователям!"
+                context,
+                update.effective_chat.id,
+                segment_name,
             )
+            if not job:
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text="В выбранной аудитории никого нет, отправлять пост некому."
+                )
 
             await asyncio.sleep(1)
-            keyboard = [
-                [InlineKeyboardButton("Конкурс", callback_data="contest")],
-                [InlineKeyboardButton("Пост", callback_data="post")],
-            ]
+            keyboard = admin_panel_keyboard()
             reply_markup = InlineKeyboardMarkup(keyboard)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -1770,10 +4061,7 @@ async def create_post_preview(update, context):
                 text=f"Ошибка при отправке поста пользователям: {str(e)}",
             )
             await asyncio.sleep(1)
-            keyboard = [
-                [InlineKeyboardButton("Конкурс", callback_data="contest")],
-                [InlineKeyboardButton("Пост", callback_data="post")],
-            ]
+            keyboard = admin_panel_keyboard()
             reply_markup = InlineKeyboardMarkup(keyboard)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -1789,6 +4077,7 @@ async def create_post_preview(update, context):
 
     return ConversationHandler.END
 
+
 async def cancel(update, context):
     await update.message.reply_text("Действие отменено.")
     return ConversationHandler.END
@@ -1802,7 +4091,7 @@ async def add_admin_command(update, context):
         return
     try:
         user_id = int(context.args[0])
-        add_admin(user_id)
+        await db.call(add_admin, user_id)
         await update.message.reply_text(f"Администратор {user_id} добавлен.")
     except (IndexError, ValueError):
         await update.message.reply_text(
@@ -1820,7 +4109,7 @@ async def remove_admin_command(update, context):
         return
 
     user_id = int(context.args[0])
-    remove_admin(user_id)
+    await db.call(remove_admin, user_id)
     await update.message.reply_text(
         f"Пользователь {user_id} удален из администраторов."
     )
@@ -1841,7 +4130,7 @@ async def verify_user_command(update, context):
         user_id = int(context.args[0])
         phone_number = context.args[1]
 
-        result = verify_specific_user(user_id, phone_number)
+        result = await db.call(verify_specific_user, user_id, phone_number)
 
         if result:
             await update.message.reply_text(
@@ -1857,13 +4146,86 @@ async def verify_user_command(update, context):
         await update.message.reply_text(f"Произошла ошибка: {str(e)}")
 
 
+# Загруженные в Telegram локальные картинки: sha256 содержимого -> file_id.
+# Ключ по содержимому: после замены файла в images/ он загрузится заново.
+_media_file_ids = {}
+# Путь -> (mtime_ns, размер, sha256), чтобы не хэшировать файл на каждый показ.
+_media_digests = {}
+# Ответы BadRequest, означающие, что сохраненный file_id больше не годится.
+STALE_FILE_ID_MESSAGES = (
+    "wrong file identifier",
+    "wrong remote file",
+    "file reference",
+    "failed to get http url content",
+)
+
+
+def load_media_file_ids():
+    """Загружает таблицу media_files в память"""
+    global _media_file_ids
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT sha256, file_id FROM media_files")
+        _media_file_ids = dict(c.fetchall())
+
+
+def save_media_file_id(digest, file_id):
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO media_files (sha256, file_id) VALUES (?, ?) "
+            "ON CONFLICT(sha256) DO UPDATE SET file_id = excluded.file_id, "
+            "updated_at = CURRENT_TIMESTAMP",
+            (digest, file_id),
+        )
+
+
+def media_digest(path):
+    """sha256 файла; пересчитывается, только если файл изменился"""
+    st = os.stat(path)
+    cached = _media_digests.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _media_digests[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+async def send_local_photo(bot, photo, **kwargs):
+    """
+    Отправляет картинку из файла photo. Файл загружается в Telegram один
+    раз, дальше сообщение уходит по сохраненному file_id. Если Telegram
+    file_id не принял, картинка загружается заново.
+    FileNotFoundError пробрасывается вызывающему, как при open().
+    """
+    # Хэширование — файловый ввод-вывод, потоки БД для него не занимаем.
+    digest = await asyncio.to_thread(media_digest, photo)
+    file_id = _media_file_ids.get(digest)
+    if file_id:
+        try:
+            return await bot.send_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            message = str(e).lower()
+            if not any(marker in message for marker in STALE_FILE_ID_MESSAGES):
+                raise
+            logger.warning(f"Cached file_id for {photo} rejected, uploading again: {e}")
+            _media_file_ids.pop(digest, None)
+    with open(photo, "rb") as photo_file:
+        message = await bot.send_photo(photo=photo_file, **kwargs)
+    _media_file_ids[digest] = message.photo[-1].file_id
+    await db.call(save_media_file_id, digest, _media_file_ids[digest])
+    logger.info(f"Uploaded {photo}, file_id cached")
+    return message
+
+
 async def start(update: Update, context: CallbackContext) -> None:
     """
     Обрабатывает команду /start, добавляет пользователя в базу данных,
     инициализирует историю навигации и показывает главное меню с видеокружком и фото.
     """
     user = update.effective_user
-    add_user(user.id)
+    register_user(user.id)
     context.user_data["history"] = ["main_menu"]
 
     video_file_id = "DQACAgIAAxkBAAIVTGfRbO4s_2jAYN-Pue8nItCoxjzOAAK7cAACR6l5Sj0Pr-SyKafSNgQ"
@@ -1876,13 +4238,13 @@ async def start(update: Update, context: CallbackContext) -> None:
     )
 
     try:
-        with open(image_path, 'rb') as photo_file:
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=photo_file,
-                caption=f"<b>Привет, {user.first_name}!</b> Я бот <b>Bazumi</b> - ваш помощник в мире игрушек. Чем могу помочь?",
-                parse_mode="HTML",
-            )
+        await send_local_photo(
+            context.bot,
+            chat_id=update.effective_chat.id,
+            photo=image_path,
+            caption=f"<b>Привет, {user.first_name}!</b> Я бот <b>Bazumi</b> - ваш помощник в мире игрушек. Чем могу помочь?",
+            parse_mode="HTML",
+        )
     except FileNotFoundError:
         logger.error(f"Фото {image_path} не найдено")
         await context.bot.send_message(
@@ -1895,6 +4257,7 @@ async def start(update: Update, context: CallbackContext) -> None:
 
     await show_main_menu(update, context)
 
+
 async def show_main_menu(
     update: Update, context: CallbackContext, is_end_of_flow: bool = False
 ) -> None:
@@ -1913,14 +4276,14 @@ async def show_main_menu(
     if is_end_of_flow:
         image_path = "images/question.png"
         try:
-            with open(image_path, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo,
-                    caption="<b>Если у вас остались вопросы, выберите нужный раздел</b>",
-                    reply_markup=reply_markup,
-                    parse_mode="HTML",
-                )
+            await send_local_photo(
+                context.bot,
+                chat_id=update.effective_chat.id,
+                photo=image_path,
+                caption="<b>Если у вас остались вопросы, выберите нужный раздел</b>",
+                reply_markup=reply_markup,
+                parse_mode="HTML",
+            )
         except FileNotFoundError:
             logger.error(f"Image file {image_path} not found.")
             await context.bot.send_message(
@@ -1966,14 +4329,14 @@ async def support_section(update: Update, context: CallbackContext) -> None:
         context.user_data["history"].append("support_section")
 
         try:
-            with open(image_path, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo,
-                    caption=text,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML",
-                )
+            await send_local_photo(
+                context.bot,
+                chat_id=update.effective_chat.id,
+                photo=image_path,
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode="HTML",
+            )
         except FileNotFoundError:
             logger.error(f"Image file {image_path} not found.")
             await context.bot.send_message(
@@ -2005,14 +4368,14 @@ async def support_section(update: Update, context: CallbackContext) -> None:
         
         image_path = "images/care.png"
         try:
-            with open(image_path, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo,
-                    caption=text,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML",
-                )
+            await send_local_photo(
+                context.bot,
+                chat_id=update.effective_chat.id,
+                photo=image_path,
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode="HTML",
+            )
         except FileNotFoundError:
             logger.error(f"Image file {image_path} not found.")
             await context.bot.send_message(
@@ -2169,7 +4532,7 @@ async def handle_support_contact(update: Update, context: CallbackContext) -> in
     
     logger.info(f"handle_support_contact called for user {user_id} with phone {phone_number}")
 
-    mark_user_verified(user_id, phone_number)
+    await db.call(mark_user_verified, user_id, phone_number)
     logger.info(f"User {user_id} verified with phone number {phone_number}")
 
     context.user_data["verification_requested"] = False
@@ -2206,7 +4569,7 @@ async def handle_videos_contact(update: Update, context: CallbackContext) -> int
     
     logger.info(f"handle_videos_contact called for user {user_id} with phone {phone_number}")
     
-    mark_user_verified(user_id, phone_number)
+    await db.call(mark_user_verified, user_id, phone_number)
     logger.info(f"User {user_id} verified with phone number {phone_number}")
     
     context.user_data["verification_requested"] = False
@@ -2276,7 +4639,7 @@ async def receive_contact(update: Update, context: CallbackContext) -> int:
     if not contest_id:
         contest = get_active_contest()
         if contest:
-            contest_id = contest[0]
+            contest_id = contest.id
             context.user_data["contest_id"] = contest_id
         else:
             await update.message.reply_text(
@@ -2286,7 +4649,10 @@ async def receive_contact(update: Update, context: CallbackContext) -> int:
             await show_main_menu(update, context, is_end_of_flow=True)
             return ConversationHandler.END
     
-    if is_participant(contest_id, user_id):
+    added = await db.call(
+        register_participant, contest_id, user_id, username, phone_number
+    )
+    if not added:
         text = "Вы уже зарегистрированы в этом конкурсе!"
         keyboard = [
             [InlineKeyboardButton("Назад", callback_data="go_back")],
@@ -2301,10 +4667,7 @@ async def receive_contact(update: Update, context: CallbackContext) -> int:
         )
         await show_main_menu(update, context, is_end_of_flow=True)
         return ConversationHandler.END
-    
-    mark_user_verified(user_id, phone_number)
-    add_participant(contest_id, user_id, username, phone_number)
-    
+
     text = "Отлично, вы зарегистрированы как участник. Желаем вам удачи и остаемся на связи! Ваш Bazumi ♥️"
     keyboard = [
         [InlineKeyboardButton("Назад", callback_data="go_back")],
@@ -2336,7 +4699,7 @@ async def gifts_section(update: Update, context: CallbackContext) -> None:
     
     contest = get_active_contest()
     if contest:
-        contest_text = format_contest_preview(contest[2], contest[3])
+        contest_text = format_contest_preview(contest.title, contest.end_date)
         text = f"{base_text}\n{contest_text}"
     else:
         text = base_text
@@ -2348,7 +4711,7 @@ async def gifts_section(update: Update, context: CallbackContext) -> None:
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     image_path = "images/contest.png"
-    contest_photo_id = contest[1] if contest else None
+    contest_photo_id = contest.photo_id if contest else None
 
     context.user_data["history"].append("gifts_section")
 
@@ -2365,14 +4728,14 @@ async def gifts_section(update: Update, context: CallbackContext) -> None:
         except Exception as e:
             logger.error(f"Error sending contest photo: {e}")
     try:
-        with open(image_path, "rb") as photo:
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=photo,
-                caption=text,
-                reply_markup=reply_markup,
-                parse_mode="HTML",
-            )
+        await send_local_photo(
+            context.bot,
+            chat_id=update.effective_chat.id,
+            photo=image_path,
+            caption=text,
+            reply_markup=reply_markup,
+            parse_mode="HTML",
+        )
     except FileNotFoundError:
         logger.error(f"Image file {image_path} not found.")
         await context.bot.send_message(
@@ -2397,13 +4760,13 @@ async def participate_gifts(update: Update, context: CallbackContext) -> None:
     contest = get_active_contest()
 
     if contest:
-        text = format_contest_preview(contest[2], contest[3])
-        contest_id = contest[0]
+        text = format_contest_preview(contest.title, contest.end_date)
+        contest_id = contest.id
     else:
         text = "В настоящее время нет активных конкурсов. Пожалуйста, следите за нашими обновлениями в канале @BAZUMI_discountt"
         contest_id = None 
 
-    if contest and is_participant(contest_id, user_id):
+    if contest and await db.call(is_participant, contest_id, user_id):
         text = "Вы уже зарегистрированы в этом конкурсе!"
         keyboard = [
             [InlineKeyboardButton("Назад", callback_data="go_back")],
@@ -2420,17 +4783,11 @@ async def participate_gifts(update: Update, context: CallbackContext) -> None:
         return
 
     if is_user_verified(user_id) and contest:
-        conn = sqlite3.connect("bazumi_bot.db")
-        c = conn.cursor()
-        c.execute(
-            "SELECT phone_number FROM verified_users WHERE user_id = ?", (user_id,)
-        )
-        result = c.fetchone()
-        conn.close()
+        phone_number = await db.call(get_verified_phone, user_id)
 
-        if result and result[0]:
-            phone_number = result[0]
-            add_participant(
+        if phone_number:
+            await db.call(
+                add_participant,
                 contest_id, user_id, update.effective_user.username, phone_number
             )
             text = "Отлично, вы зарегистрированы как участник. Желаем вам удачи и остаемся на связи! Ваш Bazumi ♥️"
@@ -2470,18 +4827,12 @@ async def confirm_not_bot_gifts(update: Update, context: CallbackContext) -> int
         context.user_data["section"] = "gifts"
         contest = get_active_contest()
         if contest:
-            conn = sqlite3.connect("bazumi_bot.db")
-            c = conn.cursor()
-            c.execute(
-                "SELECT phone_number FROM verified_users WHERE user_id = ?", (user_id,)
-            )
-            result = c.fetchone()
-            conn.close()
+            phone_number = await db.call(get_verified_phone, user_id)
 
-            if result and result[0]:
-                phone_number = result[0]
-                add_participant(
-                    contest[0], user_id, update.effective_user.username, phone_number
+            if phone_number:
+                await db.call(
+                    add_participant,
+                    contest.id, user_id, update.effective_user.username, phone_number
                 )
                 text = "Отлично, вы зарегистрированы как участник. Желаем вам удачи и остаемся на связи! Ваш Bazumi ♥️"
                 keyboard = [
@@ -2543,14 +4894,14 @@ async def videos_section(update: Update, context: CallbackContext) -> None:
     context.user_data["history"].append("videos_section")
 
     try:
-        with open(image_path, "rb") as photo:
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=photo,
-                caption=text,
-                reply_markup=reply_markup,
-                parse_mode="HTML",
-            )
+        await send_local_photo(
+            context.bot,
+            chat_id=update.effective_chat.id,
+            photo=image_path,
+            caption=text,
+            reply_markup=reply_markup,
+            parse_mode="HTML",
+        )
     except FileNotFoundError:
         logger.error(f"Image file {image_path} not found.")
         await context.bot.send_message(
@@ -2762,30 +5113,7 @@ async def error_handler(update, context):
 
 async def show_contest_menu(update, context):
     """Показывает меню управления конкурсом"""
-    keyboard = [
-        [InlineKeyboardButton("Создать новый конкурс", callback_data="create_contest")],
-        [
-            InlineKeyboardButton(
-                "Редактировать текущий конкурс", callback_data="edit_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Удалить текущий конкурс", callback_data="delete_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Уведомление о текущем конкурсе", callback_data="notify_contest"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "Выгрузить участников", callback_data="export_participants"
-            )
-        ],
-        [InlineKeyboardButton("Назад", callback_data="back_to_admin_panel")],
-    ]
+    keyboard = contest_menu_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await context.bot.send_message(
@@ -2831,10 +5159,54 @@ async def go_to_main_menu(update: Update, context: CallbackContext) -> None:
     context.user_data["history"] = ["main_menu"]
     await show_main_menu(update, context, is_end_of_flow=False)
 
+
+async def post_init(application):
+    """Запускает фоновые задачи бота после инициализации приложения"""
+    _background_tasks.append(asyncio.create_task(_new_users.run()))
+    _background_tasks.append(asyncio.create_task(_blocked_changes.run()))
+    _background_tasks.append(asyncio.create_task(_seen_users.run()))
+    _background_tasks.append(asyncio.create_task(_channel_member_changes.run()))
+    _background_tasks.append(asyncio.create_task(_participant_checks.run()))
+    await resume_broadcast_jobs(application.bot)
+    await resume_subscription_checks(application.bot)
+    _background_tasks.append(asyncio.create_task(run_scheduler(application.bot)))
+    if ADMIN_CACHE_RELOAD_INTERVAL:
+        _background_tasks.append(
+            asyncio.create_task(reload_admins_periodically(ADMIN_CACHE_RELOAD_INTERVAL))
+        )
+
+
+async def post_stop(application):
+    """Останавливает фоновые задачи перед завершением"""
+    running = [job.task for job in _broadcast_jobs.values() if job.status == "running"]
+    for task in running:
+        task.cancel()
+    # Дожидаемся, пока задания сбросят последний checkpoint в базу.
+    await asyncio.gather(*running, return_exceptions=True)
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await _new_users.flush()
+    await _blocked_changes.flush()
+    await _seen_users.flush()
+    await _channel_member_changes.flush()
+    await _participant_checks.flush()
+
+
 def main():
     global application, participate_handler
+    db.init_pool()
     init_db()
-    application = Application.builder().token("8111555224:AAGHlMmFdkjAArnldyTk4W5VFsh3dHgO6DE").build()
+    application = (
+        Application.builder()
+        .token("8111555224:AAGHlMmFdkjAArnldyTk4W5VFsh3dHgO6DE")
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .rate_limiter(PriorityRateLimiter())
+        .concurrent_updates(PerUserUpdateProcessor())
+        .build()
+    )
     
     application.add_error_handler(error_handler)
     
@@ -2862,6 +5234,7 @@ def main():
         per_user=True,
         name="participate_conversation"
     )
+    application.add_handler(TypeHandler(Update, track_activity), group=-2)
     application.add_handler(participate_handler, group=-1)
 
     create_contest_handler = ConversationHandler(
@@ -2907,7 +5280,15 @@ def main():
             ],
             CREATE_POST_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_post_title)],
             CREATE_POST_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, create_post_text)],
-            CREATE_POST_PREVIEW: [CallbackQueryHandler(create_post_preview, pattern="^(publish_post|edit_post_preview)$")],
+            CREATE_POST_PREVIEW: [
+                CallbackQueryHandler(create_post_preview, pattern="^(publish_post|edit_post_preview|publish_post_to:\\w+)$"),
+                CallbackQueryHandler(schedule_post_prompt, pattern="^schedule_post$"),
+            ],
+            SCHEDULE_POST_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, schedule_post_time)],
+            SCHEDULE_POST_AUDIENCE: [
+                CallbackQueryHandler(schedule_post_audience, pattern="^schedule_post_to:\\w+$"),
+                CallbackQueryHandler(leave_schedule, pattern="^back_to_admin_panel$"),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_message=False,
@@ -2915,6 +5296,21 @@ def main():
     )
     application.add_handler(create_post_handler, group=0)
 
+    schedule_contest_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(start_schedule_contest, pattern="^schedule_contest$")],
+        states={
+            SCHEDULE_CONTEST_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, schedule_contest_time)],
+            SCHEDULE_CONTEST_AUDIENCE: [
+                CallbackQueryHandler(schedule_contest_audience, pattern="^schedule_contest_to:\\w+$"),
+                CallbackQueryHandler(leave_schedule, pattern="^back_to_admin_panel$"),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        per_message=False,
+        name="schedule_contest_conversation"
+    )
+    application.add_handler(schedule_contest_handler, group=0)
+
     application.add_handler(CommandHandler("admin", admin_panel), group=1)
     application.add_handler(CommandHandler("add_admin", add_admin_command), group=1)
     application.add_handler(CommandHandler("remove_admin", remove_admin_command), group=1)
@@ -2923,13 +5319,24 @@ def main():
     application.add_handler(CallbackQueryHandler(contest_menu, pattern="^contest$"), group=1)
     application.add_handler(CallbackQueryHandler(delete_contest, pattern="^delete_contest$"), group=1)
     application.add_handler(CallbackQueryHandler(notify_contest, pattern="^notify_contest$"), group=1)
+    application.add_handler(CallbackQueryHandler(notify_contest_to, pattern="^notify_contest_to:"), group=1)
+    application.add_handler(CallbackQueryHandler(broadcasts_menu, pattern="^broadcasts$"), group=1)
+    application.add_handler(CallbackQueryHandler(cancel_broadcast, pattern="^cancel_broadcast:"), group=1)
+    application.add_handler(CallbackQueryHandler(cancel_scheduled, pattern="^cancel_scheduled:"), group=1)
     application.add_handler(CallbackQueryHandler(export_participants, pattern="^export_participants$"), group=1)
+    application.add_handler(CallbackQueryHandler(recheck_participants, pattern="^recheck_participants$"), group=1)
     application.add_handler(CallbackQueryHandler(confirm_delete, pattern="^confirm_delete$"), group=1)
     application.add_handler(CallbackQueryHandler(cancel_delete, pattern="^cancel_delete$"), group=1)
     application.add_handler(CallbackQueryHandler(check_subscription, pattern="^check_subscription$"), group=1)
     application.add_handler(CallbackQueryHandler(check_subscription_gifts, pattern="^check_subscription_gifts$"), group=1)
     
     application.add_handler(CommandHandler("start", start), group=1)
+    application.add_handler(
+        ChatMemberHandler(track_bot_membership, ChatMemberHandler.MY_CHAT_MEMBER), group=1
+    )
+    application.add_handler(
+        ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER), group=1
+    )
     # application.add_handler(CallbackQueryHandler(support_section, pattern='^support$'), group=1) 
     application.add_handler(CallbackQueryHandler(gifts_section, pattern='^gifts$'), group=1)
     application.add_handler(CallbackQueryHandler(videos_section, pattern='^videos$'), group=1)
@@ -2950,7 +5357,10 @@ def main():
     application.add_handler(CommandHandler("state", check_state), group=0)
     application.add_handler(CommandHandler("debug", debug_state), group=0)
     logger.info("Application handlers initialized")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        db.close_pool()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,650 @@
+"""
+Микро-бенчмарки бота Bazumi.
+
+Запуск: python benchmarks.py <сценарий> [--n N]
+Каждый сценарий работает со своей временной базой и не трогает bazumi_bot.db.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+import db
+
+
+def _temp_db_path():
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="bazumi_bench_")
+    os.close(fd)
+    return path
+
+
+def _seed(path, users):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY)")
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+        ((i,) for i in range(users)),
+    )
+    conn.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (1)")
+    conn.commit()
+    conn.close()
+
+
+def _report(name, n, elapsed):
+    print(f"{name:<32} {n:>8} вызовов  {elapsed * 1e6 / n:>9.1f} мкс/вызов")
+
+
+def _cleanup(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_pool(args):
+    """Сравнивает connect/close на каждый вызов с переиспользованием пула."""
+    path = _temp_db_path()
+    try:
+        _seed(path, 10_000)
+        n = args.n
+
+        started = time.perf_counter()
+        for i in range(n):
+            conn = sqlite3.connect(path)
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM admins WHERE user_id = ?", (i % 3,))
+            c.fetchone()
+            conn.close()
+        _report("read: connect на вызов", n, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for i in range(n):
+            conn = sqlite3.connect(path)
+            c = conn.cursor()
+            c.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (100_000 + i,))
+            conn.commit()
+            conn.close()
+        _report("write: connect на вызов", n, time.perf_counter() - started)
+
+        db.init_pool(path)
+        started = time.perf_counter()
+        for i in range(n):
+            with db.reader() as conn:
+                c = conn.cursor()
+                c.execute("SELECT 1 FROM admins WHERE user_id = ?", (i % 3,))
+                c.fetchone()
+        _report("read: пул (WAL)", n, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for i in range(n):
+            with db.writer() as conn:
+                c = conn.cursor()
+                c.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (200_000 + i,))
+        _report("write: пул (WAL)", n, time.perf_counter() - started)
+    finally:
+        db.close_pool()
+        _cleanup(path)
+
+
+def bench_loop_lag(args):
+    """
+    Задержка цикла событий при N одновременных фейковых апдейтах:
+    хелпер вызывается прямо в корутине или через db.call().
+    --disk-latency-ms имитирует медленный fsync внутри транзакции.
+    Затем те же апдейты проходят через обработчик апдейтов PTB: по одному
+    (по умолчанию в Application) и через PerUserUpdateProcessor бота.
+    """
+    from types import SimpleNamespace
+
+    from telegram.ext import SimpleUpdateProcessor
+
+    from bazumi_bot import PerUserUpdateProcessor
+
+    path = _temp_db_path()
+    try:
+        _seed(path, 0)
+        db.init_pool(path)
+        with db.writer() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS participants (
+                contest_id INTEGER, user_id INTEGER, PRIMARY KEY (contest_id, user_id))"""
+            )
+
+        def add_participant(contest_id, user_id):
+            with db.writer() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO participants (contest_id, user_id) VALUES (?, ?)",
+                    (contest_id, user_id),
+                )
+                if args.disk_latency_ms:
+                    time.sleep(args.disk_latency_ms / 1000)
+
+        async def handle(contest_id, user_id, mode):
+            if mode == "sync":
+                add_participant(contest_id, user_id)
+            else:
+                await db.call(add_participant, contest_id, user_id)
+            # Ответ пользователю через Bot API.
+            await asyncio.sleep(0.05)
+
+        async def fake_update(contest_id, user_id, mode, processor):
+            await asyncio.sleep(random.random() * 0.5)
+            if processor is None:
+                await handle(contest_id, user_id, mode)
+                return
+            update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+            await processor.process_update(update, handle(contest_id, user_id, mode))
+
+        async def monitor(lags, stop):
+            interval = 0.005
+            while not stop.is_set():
+                expected = time.perf_counter() + interval
+                await asyncio.sleep(interval)
+                lags.append(max(0.0, time.perf_counter() - expected))
+
+        async def run(contest_id, mode, name=None, processor=None):
+            lags = []
+            stop = asyncio.Event()
+            monitor_task = asyncio.create_task(monitor(lags, stop))
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(fake_update(contest_id, i, mode, processor) for i in range(args.n))
+            )
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await monitor_task
+            print(
+                f"{name or mode:<8} апдейтов={args.n} время={elapsed:.2f}с "
+                f"лаг p50={_percentile(lags, 0.5) * 1e3:.1f}мс "
+                f"p99={_percentile(lags, 0.99) * 1e3:.1f}мс "
+                f"max={max(lags, default=0) * 1e3:.1f}мс"
+            )
+
+        asyncio.run(run(1, "sync"))
+        asyncio.run(run(2, "async"))
+        asyncio.run(run(3, "async", "ptb", SimpleUpdateProcessor(1)))
+        asyncio.run(run(4, "async", "per-user", PerUserUpdateProcessor()))
+    finally:
+        db.close_pool()
+        _cleanup(path)
+
+
+def bench_verified_memory(args):
+    """Память и время проверки индекса верифицированных пользователей."""
+    from bazumi_bot import UserIdSet
+
+    rng = random.Random(42)
+    ids = rng.sample(range(10**6, 8 * 10**9), args.n)
+    probes = [rng.choice(ids) if i % 2 else rng.randrange(10**9) for i in range(100_000)]
+
+    as_set = set(ids)
+    # Таблица set плюс сами объекты int, которые он удерживает.
+    set_bytes = sys.getsizeof(as_set) + sum(sys.getsizeof(i) for i in ids)
+
+    index = UserIdSet(ids)
+    per_million = 10**6 / args.n
+
+    for name, container, size in (
+        ("set[int]", as_set, set_bytes),
+        ("UserIdSet", index, index.nbytes()),
+    ):
+        started = time.perf_counter()
+        for user_id in probes:
+            user_id in container
+        elapsed = time.perf_counter() - started
+        print(
+            f"{name:<10} id={args.n} память={size / 2**20:.1f} МиБ "
+            f"(~{size * per_million / 2**20:.1f} МиБ на 1М) "
+            f"проверка={elapsed * 1e9 / len(probes):.0f} нс"
+        )
+
+
+class FakeBotAPI:
+    """
+    Локальный HTTP-сервер, отвечающий как Bot API: каждый запрос ждет
+    latency секунд, больше rate_limit сообщений в секунду получают 429.
+    Чатам из blocked отвечает 403, как для заблокировавших бота;
+    getChatMember для пользователей из unsubscribed возвращает «left».
+    """
+
+    def __init__(self, latency=0.15, rate_limit=30, blocked=(), unsubscribed=()):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.blocked = set(blocked)
+        self.unsubscribed = set(unsubscribed)
+        self.port = None
+        self.accepted = 0
+        self.rejected = 0
+        self._window = []
+        self._message_id = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return 200, {
+                "ok": True,
+                "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"},
+            }
+        now = time.monotonic()
+        self._window = [t for t in self._window if now - t < 1.0]
+        if len(self._window) >= self.rate_limit:
+            self.rejected += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }
+        self._window.append(now)
+        if params.get("chat_id", [None])[0] in self.blocked:
+            return 403, {
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user",
+            }
+        self.accepted += 1
+        if method == "getChatMember":
+            user_id = params["user_id"][0]
+            status = "left" if user_id in self.unsubscribed else "member"
+            return 200, {
+                "ok": True,
+                "result": {
+                    "status": status,
+                    "user": {"id": int(user_id), "is_bot": False, "first_name": "Bench"},
+                },
+            }
+        self._message_id += 1
+        return 200, {
+            "ok": True,
+            "result": {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": 1, "type": "private"},
+            },
+        }
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value)
+                body = await reader.readexactly(length) if length else b""
+                method = request_line.split()[1].decode().rsplit("/", 1)[-1]
+                await asyncio.sleep(self.latency)
+                status, payload = self._result(method, parse_qs(body.decode()))
+                body = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _fake_bot(api, pool_size=64):
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    bot = Bot(
+        "123:bench",
+        base_url=api.base_url,
+        request=HTTPXRequest(connection_pool_size=pool_size),
+    )
+    await bot.initialize()
+    return bot
+
+
+def bench_broadcast(args):
+    """
+    Рассылка N сообщений через локальный фейковый Bot API: прежний
+    последовательный цикл против broadcast() с параллелизмом и token bucket.
+    --dead-share задает долю пользователей, заблокировавших бота: тогда
+    broadcast() запускается второй раз уже без помеченных недоступными.
+    """
+    from bazumi_bot import (
+        BROADCAST_CONCURRENCY,
+        BROADCAST_RATE,
+        SEND_UNREACHABLE,
+        broadcast,
+    )
+
+    async def sequential(bot, user_ids):
+        sent = 0
+        for user_id in user_ids:
+            try:
+                await bot.send_message(chat_id=user_id, text="bench")
+                sent += 1
+            except Exception:
+                pass
+        return sent
+
+    async def run():
+        user_ids = list(range(1, args.n + 1))
+        dead = random.Random(42).sample(user_ids, int(args.n * args.dead_share))
+        api = FakeBotAPI(latency=args.latency_ms / 1000, blocked=(str(i) for i in dead))
+        await api.start()
+        bot = await _fake_bot(api)
+        try:
+            started = time.perf_counter()
+            sent = await sequential(bot, user_ids)
+            elapsed = time.perf_counter() - started
+            print(f"последовательно: отправлено={sent} за {elapsed:.1f}с ({sent / elapsed:.1f} сообщ/с)")
+
+            api.rejected = 0
+
+            async def send(user_id):
+                await bot.send_message(chat_id=user_id, text="bench")
+
+            unreachable = set()
+
+            def on_result(user_id, outcome):
+                if outcome == SEND_UNREACHABLE:
+                    unreachable.add(user_id)
+
+            rate = args.rate or BROADCAST_RATE
+            stats = await broadcast(user_ids, send, rate=rate, on_result=on_result)
+            print(
+                f"broadcast(rate={rate}, concurrency={BROADCAST_CONCURRENCY}): "
+                f"{stats.summary()} 429 от сервера={api.rejected}"
+            )
+            if unreachable:
+                reachable = [user_id for user_id in user_ids if user_id not in unreachable]
+                stats = await broadcast(reachable, send, rate=rate)
+                print(f"повторно без недоступных: {stats.summary()}")
+        finally:
+            await bot.shutdown()
+            await api.stop()
+
+    asyncio.run(run())
+
+
+def bench_audience_stream(args):
+    """
+    Время до первого получателя и пиковая память: get_all_users() со списком
+    всей аудитории против постраничного iter_job_recipients(), которым
+    читает аудиторию задание рассылки (снимок в файлах, курсор в базе).
+    """
+    import tracemalloc
+
+    import bazumi_bot
+
+    path = _temp_db_path()
+    try:
+        db.init_pool(path)
+        bazumi_bot.apply_migrations()
+        bazumi_bot.add_users(range(1, args.n + 1))
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        users = bazumi_bot.get_all_users()
+        first = time.perf_counter() - started
+        for user_id in users:
+            pass
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del users
+        print(
+            f"get_all_users  id={args.n} первый={first * 1e3:.1f}мс "
+            f"всего={elapsed:.2f}с пик={peak / 2**20:.1f} МиБ"
+        )
+
+        job_id = bazumi_bot.create_broadcast_job("bench", {}, 1, 1, args.n)
+        snapshot = bazumi_bot.AudienceSnapshot(path + ".snapshot")
+        job = bazumi_bot.BroadcastJob(
+            job_id, "bench", bazumi_bot.BroadcastStats(args.n), snapshot
+        )
+
+        async def stream():
+            first = None
+            started = time.perf_counter()
+            async for user_id in bazumi_bot.iter_job_recipients(job, None):
+                if first is None:
+                    first = time.perf_counter() - started
+            return first, time.perf_counter() - started
+
+        tracemalloc.start()
+        first, elapsed = asyncio.run(stream())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"iter_job_recipients id={args.n} первый={first * 1e3:.1f}мс "
+            f"всего={elapsed:.2f}с пик={peak / 2**20:.1f} МиБ"
+        )
+        snapshot.remove()
+    finally:
+        db.close_pool()
+        _cleanup(path)
+
+
+def bench_recheck(args):
+    """
+    Перепроверка подписки N участников конкурса через фейковый Bot API:
+    последовательные вызовы getChatMember против фоновой проверки
+    _run_subscription_check. --dead-share — доля отписавшихся.
+    """
+    import bazumi_bot
+
+    async def run():
+        user_ids = list(range(1, args.n + 1))
+        left = random.Random(42).sample(user_ids, int(args.n * args.dead_share))
+        api = FakeBotAPI(latency=args.latency_ms / 1000, unsubscribed=(str(i) for i in left))
+        await api.start()
+        bot = await _fake_bot(api)
+        try:
+            started = time.perf_counter()
+            unsubscribed = 0
+            for user_id in user_ids:
+                member = await bot.get_chat_member(chat_id=bazumi_bot.SUBSCRIPTION_CHANNEL, user_id=user_id)
+                unsubscribed += member.status not in bazumi_bot.SUBSCRIBED_STATUSES
+            elapsed = time.perf_counter() - started
+            print(
+                f"последовательно: проверено={args.n} не подписаны={unsubscribed} "
+                f"за {elapsed:.1f}с ({args.n / elapsed:.1f} проверок/с)"
+            )
+
+            api.rejected = 0
+            check_id, since = bazumi_bot.create_subscription_check(1, 1, 1)
+            started = time.perf_counter()
+            await bazumi_bot._run_subscription_check(bot, check_id, 1, since, 1, 1)
+            elapsed = time.perf_counter() - started
+            total, checked, unsubscribed, errors = bazumi_bot.count_participant_checks(1, since)
+            print(
+                f"_run_subscription_check(rate={bazumi_bot.SUBSCRIPTION_CHECK_RATE}, "
+                f"concurrency={bazumi_bot.SUBSCRIPTION_CHECK_CONCURRENCY}): проверено={checked} "
+                f"не подписаны={unsubscribed} ошибок={errors} за {elapsed:.1f}с "
+                f"({checked / elapsed:.1f} проверок/с) 429 от сервера={api.rejected}"
+            )
+        finally:
+            await bot.shutdown()
+            await api.stop()
+
+    path = _temp_db_path()
+    try:
+        db.init_pool(path)
+        bazumi_bot.apply_migrations()
+        with db.writer() as conn:
+            conn.executemany(
+                "INSERT INTO participants (contest_id, user_id, username, phone_number) "
+                "VALUES (1, ?, NULL, NULL)",
+                ((i,) for i in range(1, args.n + 1)),
+            )
+        asyncio.run(run())
+    finally:
+        db.close_pool()
+        _cleanup(path)
+
+
+def bench_snapshot_memory(args):
+    """
+    Память снимка аудитории на 100k / 1M / 5M получателей: list[int]
+    против AudienceSnapshot (array('q') и битовая карта) в памяти и через mmap.
+    """
+    from bazumi_bot import AudienceSnapshot
+
+    directory = tempfile.mkdtemp(prefix="bazumi_bench_")
+    try:
+        for n in (100_000, 1_000_000, 5_000_000):
+            start = 10**9
+            as_list = list(range(start, start + 7 * n, 7))
+            list_bytes = sys.getsizeof(as_list) + sum(sys.getsizeof(i) for i in as_list)
+            path = os.path.join(directory, f"snapshot_{n}")
+            snapshot = AudienceSnapshot(path)
+            snapshot.append(as_list)
+            snapshot.mark_done(as_list[::2])
+            snapshot.save_done()
+            del as_list
+            mapped = AudienceSnapshot.load(path, use_mmap=True)
+            pending = sum(1 for _ in mapped.pending())
+            print(
+                f"получателей={n:>9} list[int]={list_bytes / 2**20:7.1f} МиБ "
+                f"array+bitmap={snapshot.nbytes() / 2**20:6.1f} МиБ "
+                f"mmap (в куче)={mapped.nbytes() / 2**20:5.2f} МиБ "
+                f"осталось={pending}"
+            )
+            mapped.remove()
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def bench_priority(args):
+    """
+    Задержка ответов на нажатия кнопок (p50/p95) во время рассылки через
+    фейковый Bot API: без рассылки, с рассылкой без общего планировщика
+    и с рассылкой через PriorityRateLimiter.
+    """
+    from telegram.error import RetryAfter
+    from telegram.ext import ExtBot
+    from telegram.request import HTTPXRequest
+
+    from bazumi_bot import BROADCAST_RATE, PRIORITY_BULK, PriorityRateLimiter, broadcast
+
+    async def tap(bot, chat_id, latencies):
+        started = time.perf_counter()
+        for _ in range(5):
+            try:
+                await bot.send_message(chat_id=chat_id, text="menu")
+                break
+            except RetryAfter as e:
+                # Без планировщика хендлер получает 429 и отвечает только после паузы.
+                await asyncio.sleep(e.retry_after if isinstance(e.retry_after, int) else 1)
+        latencies.append(time.perf_counter() - started)
+
+    async def run_case(name, limiter, with_broadcast):
+        api = FakeBotAPI(latency=args.latency_ms / 1000)
+        await api.start()
+        bot = ExtBot(
+            "123:bench",
+            base_url=api.base_url,
+            request=HTTPXRequest(connection_pool_size=64),
+            rate_limiter=limiter,
+        )
+        await bot.initialize()
+        extra = {"rate_limit_args": {"priority": PRIORITY_BULK}} if limiter else {}
+
+        async def send(user_id):
+            await bot.send_message(chat_id=user_id, text="bulk", **extra)
+
+        bulk = None
+        try:
+            if with_broadcast:
+                bulk = asyncio.create_task(
+                    broadcast(
+                        range(1, args.n + 1),
+                        send,
+                        rate=None if limiter else args.rate or BROADCAST_RATE,
+                    )
+                )
+                await asyncio.sleep(1)
+            latencies = []
+            taps = []
+            for i in range(int(args.taps_rate * 10)):
+                taps.append(asyncio.create_task(tap(bot, 10**6 + i, latencies)))
+                await asyncio.sleep(1 / args.taps_rate)
+            await asyncio.gather(*taps)
+            print(
+                f"{name:<28} нажатий={len(latencies)} "
+                f"p50={_percentile(latencies, 0.5) * 1e3:.0f}мс "
+                f"p95={_percentile(latencies, 0.95) * 1e3:.0f}мс 429={api.rejected}"
+            )
+        finally:
+            if bulk:
+                bulk.cancel()
+                await asyncio.gather(bulk, return_exceptions=True)
+            await bot.shutdown()
+            await api.stop()
+
+    async def run():
+        await run_case("без рассылки", None, False)
+        await run_case("рассылка без планировщика", None, True)
+        await run_case("рассылка + PriorityRateLimiter", PriorityRateLimiter(), True)
+
+    asyncio.run(run())
+
+
+SCENARIOS = {
+    "pool": bench_pool,
+    "loop-lag": bench_loop_lag,
+    "verified-memory": bench_verified_memory,
+    "broadcast": bench_broadcast,
+    "audience-stream": bench_audience_stream,
+    "snapshot-memory": bench_snapshot_memory,
+    "recheck": bench_recheck,
+    "priority": bench_priority,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--n", type=int, default=2000)
+    parser.add_argument("--disk-latency-ms", type=float, default=0.0)
+    parser.add_argument("--latency-ms", type=float, default=150.0)
+    parser.add_argument("--rate", type=float, default=None)
+    parser.add_argument("--dead-share", type=float, default=0.0)
+    parser.add_argument("--taps-rate", type=float, default=8.0)
+    args = parser.parse_args()
+    SCENARIOS[args.scenario](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Общий слой соединений с SQLite для бота Bazumi.
+
+Держит одно долгоживущее соединение на запись и небольшой пул соединений
+на чтение, включает WAL и прагмы один раз при старте. Хелперы бота берут
+соединения через reader() / writer() вместо sqlite3.connect() на каждый вызов.
+
+Асинхронные хендлеры не вызывают хелперы напрямую, а ждут их через call():
+запрос выполняется в отдельном пуле потоков БД, и цикл событий не стоит,
+пока диск занят.
+"""
+import asyncio
+import functools
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+DB_PATH = "bazumi_bot.db"
+READER_POOL_SIZE = 4
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+_executor = None
+
+
+class ConnectionPool:
+    """Один писатель под блокировкой и очередь читателей."""
+
+    def __init__(self, path=DB_PATH, readers=READER_POOL_SIZE):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma).fetchall()
+        return conn
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        """Выдает соединение на запись; commit при выходе, rollback при ошибке."""
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def init_pool(path=DB_PATH, readers=READER_POOL_SIZE):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(path, readers)
+    return _pool
+
+
+def get_pool():
+    if _pool is None:
+        return init_pool()
+    return _pool
+
+
+def reader():
+    return get_pool().reader()
+
+
+def writer():
+    return get_pool().writer()
+
+
+def get_executor():
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            # Читатели плюс писатель: больше потоков все равно ждали бы соединение.
+            _executor = ThreadPoolExecutor(
+                max_workers=READER_POOL_SIZE + 1, thread_name_prefix="db"
+            )
+    return _executor
+
+
+async def call(func, *args, **kwargs):
+    """Выполняет синхронный хелпер в потоке БД и возвращает его результат."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def close_pool():
+    global _pool, _executor
+    with _pool_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _pool is not None:
+            _pool.close()
+            _pool = None